@@ -0,0 +1,544 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import xarray as xr
+import numba as nb
+from scipy import fft
+from preprocess import file_signature
+
+
+# per-trajectory loop, compiled once for each kernel and number of input arrays
+_DRIVER = '''
+def driver(offsets, out, {args}):
+    for i in nb.prange(len(offsets) - 1):
+        start, end = offsets[i], offsets[i + 1]
+        {body}
+'''
+_drivers = {}
+_kernels = {}  # python kernels jitted by _prepare, by _kernel_key
+
+
+def _kernel_key(kernel):
+    '''
+    Cache key of a python kernel: its code and the values it captures, so a lambda created
+    again at each call reuses the compiled kernel (None if a captured value is not hashable)
+    '''
+    closure = tuple(cell.cell_contents for cell in kernel.__closure__ or ())
+    key = (kernel.__code__, closure, kernel.__defaults__)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _driver(kernel, key, nargs, reduce, parallel):
+    '''
+    Jitted loop calling kernel on the segment of every trajectory (cached by the key of the kernel)
+    '''
+    key = (key, nargs, reduce, parallel)
+    if key not in _drivers:
+        args = ', '.join(f'x{k}' for k in range(nargs))
+        slices = ', '.join(f'x{k}[start:end]' for k in range(nargs))
+        if reduce:
+            body = f'out[i] = kernel({slices})'
+        else:
+            body = f'kernel({slices}, out[start:end])'
+        namespace = {'nb': nb, 'kernel': kernel}
+        exec(_DRIVER.format(args=args, body=body), namespace)
+        driver = nb.njit(parallel=parallel)(namespace['driver'])
+        if key[0] is None:
+            return driver
+        _drivers[key] = driver
+    return _drivers[key]
+
+
+def _prepare(kernel, rowsize, arrays):
+    if isinstance(kernel, nb.core.dispatcher.Dispatcher):
+        key = kernel
+    else:
+        key = _kernel_key(kernel)
+        if key is None:
+            kernel = nb.njit(kernel)
+        else:
+            if key not in _kernels:
+                _kernels[key] = nb.njit(kernel)
+            kernel = _kernels[key]
+    rowsize = np.asarray(rowsize, dtype='int64')
+    offsets = np.zeros(len(rowsize) + 1, dtype='int64')
+    np.cumsum(rowsize, out=offsets[1:])
+    arrays = tuple(np.ascontiguousarray(a) for a in arrays)
+    for a in arrays:
+        if len(a) != offsets[-1]:
+            raise ValueError(f'The arrays must have sum(rowsize)={offsets[-1]} elements (got {len(a)}).')
+    return kernel, key, offsets, arrays
+
+
+def ragged_reduce(kernel, rowsize, *arrays, dtype='float64', parallel=True) -> np.ndarray:
+    '''
+    Apply a reduction to the observations of every trajectory of a ragged array
+
+    :param kernel: function taking the segments of one trajectory of each array and returning
+                   a scalar, preferably a named @nb.njit function (compiled once), e.g.
+                   `@nb.njit
+                   def mean_speed(ve, vn): return np.nanmean(np.sqrt(ve**2 + vn**2))`
+                   A python function is jitted and cached by its code and captured values.
+           rowsize: number of observations per trajectory
+           arrays: variables along the 'obs' dimension
+           dtype: type of the output
+           parallel: distribute the trajectories over the numba threads
+    :return: array[traj]
+    '''
+    kernel, key, offsets, arrays = _prepare(kernel, rowsize, arrays)
+    out = np.empty(len(offsets) - 1, dtype=dtype)
+    _driver(kernel, key, len(arrays), True, parallel)(offsets, out, *arrays)
+    return out
+
+
+def ragged_transform(kernel, rowsize, *arrays, dtype='float64', parallel=True) -> np.ndarray:
+    '''
+    Apply a transformation to the observations of every trajectory of a ragged array
+
+    :param kernel: function taking the segments of one trajectory of each array followed by
+                   the output segment to fill, preferably a named @nb.njit function, e.g.
+                   `@nb.njit
+                   def anomaly(x, out): out[:] = x - np.nanmean(x)`
+           rowsize: number of observations per trajectory
+           arrays: variables along the 'obs' dimension
+           dtype: type of the output
+           parallel: distribute the trajectories over the numba threads
+    :return: array[obs]
+    '''
+    kernel, key, offsets, arrays = _prepare(kernel, rowsize, arrays)
+    out = np.empty(offsets[-1], dtype=dtype)
+    _driver(kernel, key, len(arrays), False, parallel)(offsets, out, *arrays)
+    return out
+
+
+def fft_lengths(rowsize, pad=None, tolerance=0.1) -> np.ndarray:
+    '''
+    FFT length of each trajectory. With padding, the trajectories of close lengths are zero-padded
+    to the same length so they can be transformed together.
+
+    :param rowsize: number of observations per trajectory
+           pad: None (exact lengths), 'pow2' (powers of two) or 'smooth' (5-smooth numbers 2^i 3^j 5^k)
+           tolerance: maximum padding of a bucket relative to its shortest trajectory, e.g. 0.1
+                      pads at most 10% (a larger padding is used if no length fits in the tolerance)
+    :return: int array[traj]
+    '''
+    rowsize = np.asarray(rowsize, dtype='int64')
+    if pad is None or len(rowsize) == 0:
+        return rowsize.copy()
+
+    top = 2 * max(int(rowsize.max()), 1)
+    powers = lambda base: base ** np.arange(int(np.log(top) / np.log(base)) + 1, dtype='int64')
+    if pad == 'pow2':
+        sizes = powers(2)
+    elif pad == 'smooth':
+        sizes = np.unique(powers(2)[:, None, None] * powers(3)[None, :, None] * powers(5)[None, None, :])
+        sizes = sizes[sizes <= top]
+    else:
+        raise ValueError(f"pad must be None, 'pow2' or 'smooth' (got {pad!r})")
+
+    # buckets from the shortest trajectory: all the lengths up to the largest size within the tolerance
+    # (empty trajectories keep a length of 0 and are not bucketed)
+    lengths = np.unique(rowsize)
+    nfft = np.zeros_like(lengths)
+    i = np.searchsorted(lengths, 1)
+    while i < len(lengths):
+        size = sizes[np.searchsorted(sizes, lengths[i] * (1 + tolerance), side='right') - 1]
+        if size < lengths[i]:
+            size = sizes[np.searchsorted(sizes, lengths[i])]
+        j = np.searchsorted(lengths, size, side='right')
+        nfft[i:j] = size
+        i = j
+    return nfft[np.searchsorted(lengths, rowsize)]
+
+
+def ragged_periodogram(rowsize, x, y=None, dt=1/24, workers=None, max_batch_size=2**24):
+    '''
+    Periodogram `dt*|fft(x)|**2` of every trajectory, returned along the 'obs' dimension
+
+    The trajectories are grouped by length and each group is transformed with a few
+    2-D FFTs (at most `max_batch_size` values per call) instead of one FFT per trajectory.
+    For a real signal only half of the spectrum is computed (rfft) and mirrored.
+    Almost every trajectory has its own length, so the groups are small: see padded_periodogram
+    to transform the trajectories in large batches.
+
+    :param rowsize: number of observations per trajectory
+           x: signal along the 'obs' dimension (real or complex)
+           y: optional imaginary part, the signal is then x + 1j*y (e.g. ve and vn)
+           dt: sampling interval
+           workers: number of threads used by each FFT (see scipy.fft)
+           max_batch_size: maximum number of values transformed at once
+    :return: periodogram[obs]
+    '''
+    rowsize = np.asarray(rowsize, dtype='int64')
+    return _periodogram(rowsize, rowsize, x, y, dt, workers, max_batch_size)
+
+
+def padded_periodogram(rowsize, x, y=None, dt=1/24, workers=None, max_batch_size=2**24, pad='smooth', tolerance=0.1):
+    '''
+    Periodogram `dt*|fft(x)|**2` of every trajectory zero-padded to a few bucket lengths
+
+    Same as ragged_periodogram, but the trajectories are zero-padded to the lengths given by
+    fft_lengths and transformed in large batches. The periodogram of a trajectory of n
+    observations padded to nfft is given at the frequencies k/(nfft*dt), k=0..nfft-1 (see
+    np.fft.fftfreq(nfft, dt)) instead of k/(n*dt): the padding interpolates the spectrum on a
+    finer grid, the values at the frequencies common to both grids are the same.
+    pad='smooth' pads much less than 'pow2' (about 4% against 44% with tolerance=0.1 for the
+    lengths of benchmark.synthetic_rowsize) and is usually the fastest.
+
+    :param rowsize: number of observations per trajectory
+           x: signal along the 'obs' dimension (real or complex)
+           y: optional imaginary part, the signal is then x + 1j*y (e.g. ve and vn)
+           dt: sampling interval
+           workers: number of threads used by each FFT (see scipy.fft)
+           max_batch_size: maximum number of values transformed at once
+           pad: None, 'pow2' or 'smooth', padding of the trajectories (see fft_lengths)
+           tolerance: maximum relative padding of the buckets (see fft_lengths)
+    :return: periodogram (ragged array of nfft values per trajectory), nfft[traj]
+    '''
+    rowsize = np.asarray(rowsize, dtype='int64')
+    nfft = fft_lengths(rowsize, pad, tolerance)
+    return _periodogram(rowsize, nfft, x, y, dt, workers, max_batch_size), nfft
+
+
+def _periodogram(rowsize, nfft, x, y, dt, workers, max_batch_size):
+    offsets = np.insert(np.cumsum(rowsize), 0, 0)[:-1]
+    out_offsets = np.insert(np.cumsum(nfft), 0, 0)[:-1]
+    x = np.asarray(x)
+    y = None if y is None else np.asarray(y)
+    is_complex = y is not None or np.iscomplexobj(x)
+    out = np.empty(np.sum(nfft), dtype='float64')
+
+    # trajectories sorted by FFT length, split in groups of identical length
+    order = np.argsort(nfft, kind='stable')
+    lengths, first = np.unique(nfft[order], return_index=True)
+    groups = np.split(order, first[1:])
+
+    for n, group in zip(lengths, groups):
+        if n == 0:
+            continue
+        rows = max(1, max_batch_size // n)
+        for batch in range(0, len(group), rows):
+            traj = group[batch:batch + rows]
+            index = offsets[traj, None] + np.arange(n)
+            if np.all(rowsize[traj] == n):
+                block = x[index].astype('complex128' if is_complex else 'float64')
+                if y is not None:
+                    block += 1j * y[index]
+            else:
+                valid = np.arange(n) < rowsize[traj, None]  # zero padding
+                block = np.zeros(index.shape, dtype='complex128' if is_complex else 'float64')
+                block[valid] = x[index[valid]]
+                if y is not None:
+                    block[valid] += 1j * y[index[valid]]
+
+            out_index = out_offsets[traj, None] + np.arange(n)
+            if is_complex:
+                out[out_index] = dt * np.abs(fft.fft(block, axis=1, workers=workers))**2
+            else:
+                half = dt * np.abs(fft.rfft(block, axis=1, workers=workers))**2
+                spectrum = np.empty(block.shape, dtype='float64')
+                spectrum[:, :half.shape[1]] = half
+                spectrum[:, half.shape[1]:] = half[:, 1:(n + 1) // 2][:, ::-1]  # P[n-k] = P[k]
+                out[out_index] = spectrum
+
+    return out
+
+
+@nb.njit(nogil=True)
+def _bin_index(edges, value):
+    # same convention as scipy.stats.binned_statistic: the last bin includes its right edge
+    if not (edges[0] <= value <= edges[-1]):
+        return -1
+    if value == edges[-1]:
+        return len(edges) - 2
+    return np.searchsorted(edges, value, side='right') - 1
+
+
+@nb.njit(nogil=True)
+def _accumulate(x, y, values, xedges, yedges, count, mean, m2, vmin, vmax):
+    for k in range(len(values)):
+        v = values[k]
+        if np.isnan(v):
+            continue
+        i = _bin_index(xedges, x[k])
+        j = _bin_index(yedges, y[k])
+        if i < 0 or j < 0:
+            continue
+        # Welford's online mean and variance
+        count[i, j] += 1
+        delta = v - mean[i, j]
+        mean[i, j] += delta / count[i, j]
+        m2[i, j] += delta * (v - mean[i, j])
+        if v < vmin[i, j]:
+            vmin[i, j] = v
+        if v > vmax[i, j]:
+            vmax[i, j] = v
+
+
+def _binned_dataset(xedges, yedges, count, mean, m2, vmin, vmax) -> xr.Dataset:
+    empty = count == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = m2 / count
+    return xr.Dataset(
+        data_vars=dict(
+            count=(['x', 'y'], count, {'long_name': 'Number of valid values per bin'}),
+            sum=(['x', 'y'], np.where(empty, np.nan, mean * count), {'long_name': 'Sum per bin'}),
+            mean=(['x', 'y'], np.where(empty, np.nan, mean), {'long_name': 'Mean per bin'}),
+            var=(['x', 'y'], np.where(empty, np.nan, var), {'long_name': 'Variance per bin'}),
+            min=(['x', 'y'], np.where(empty, np.nan, vmin), {'long_name': 'Minimum per bin'}),
+            max=(['x', 'y'], np.where(empty, np.nan, vmax), {'long_name': 'Maximum per bin'}),
+            m2=(['x', 'y'], m2, {'long_name': 'Sum of the squared differences from the mean per bin'}),
+        ),
+        coords=dict(
+            x=(['x'], 0.5 * (xedges[1:] + xedges[:-1])),
+            y=(['y'], 0.5 * (yedges[1:] + yedges[:-1])),
+            x_edges=(['x_edges'], xedges),
+            y_edges=(['y_edges'], yedges),
+        ),
+    )
+
+
+def binned_statistics(x, y, values, bins, chunk_size=2**22, workers=1) -> xr.Dataset:
+    '''
+    Count, sum, mean, variance, minimum and maximum of values in the bins of a 2-D grid, in
+    one pass over the observations. NaN values are ignored (as np.nanmean).
+
+    The observations are read by chunks of `chunk_size` (e.g. from a lazily opened
+    xr.Dataset or a memory-mapped array), so the arrays never have to be loaded at once.
+
+    :param x, y: positions of the observations (e.g. ds.lon, ds.lat)
+           values: observations (e.g. ds.ve)
+           bins: [xedges, yedges] as in scipy.stats.binned_statistic_2d
+           chunk_size: number of observations read at a time
+           workers: number of threads, each accumulating its own chunks
+    :return: xr.Dataset with the statistics per bin ['x', 'y'], see merge_binned_statistics
+             to combine results computed on different parts of the observations
+    '''
+    xedges = np.asarray(bins[0], dtype='float64')
+    yedges = np.asarray(bins[1], dtype='float64')
+    shape = (len(xedges) - 1, len(yedges) - 1)
+
+    def accumulate(starts):
+        count = np.zeros(shape, dtype='int64')
+        mean = np.zeros(shape)
+        m2 = np.zeros(shape)
+        vmin = np.full(shape, np.inf)
+        vmax = np.full(shape, -np.inf)
+        for start in starts:
+            chunk = slice(start, start + chunk_size)
+            _accumulate(
+                np.asarray(x[chunk], dtype='float64'),
+                np.asarray(y[chunk], dtype='float64'),
+                np.asarray(values[chunk], dtype='float64'),
+                xedges, yedges, count, mean, m2, vmin, vmax,
+            )
+        return _binned_dataset(xedges, yedges, count, mean, m2, vmin, vmax)
+
+    starts = np.arange(0, len(values), chunk_size)
+    if workers == 1:
+        return accumulate(starts)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        partials = list(executor.map(accumulate, np.array_split(starts, workers)))
+    return merge_binned_statistics(*partials)
+
+
+def merge_binned_statistics(*partials) -> xr.Dataset:
+    '''
+    Combine binned statistics computed on different chunks of observations (same bins)
+    '''
+    result = partials[0]
+    for other in partials[1:]:
+        na, nb_ = result['count'].values, other['count'].values
+        n = na + nb_
+        ma = np.nan_to_num(result['mean'].values)
+        mb = np.nan_to_num(other['mean'].values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = mb - ma
+            mean = np.where(n > 0, ma + delta * nb_ / n, 0)
+            m2 = result['m2'].values + other['m2'].values + np.where(n > 0, delta**2 * na * nb_ / n, 0)
+        vmin = np.fmin(result['min'].values, other['min'].values)
+        vmax = np.fmax(result['max'].values, other['max'].values)
+        result = _binned_dataset(result.x_edges.values, result.y_edges.values, n, mean, m2, vmin, vmax)
+    return result
+
+
+# common kernels
+@nb.njit
+def nanmean(x):
+    return np.nanmean(x) if len(x) else np.nan
+
+
+@nb.njit
+def anomaly(x, out):
+    out[:] = x - nanmean(x)
+
+
+@nb.njit
+def nanstd(x):
+    return np.nanstd(x) if len(x) else np.nan
+
+
+OMEGA = 7.2921159e-5  # Earth's rotation rate [rad/s]
+
+# derived variables: name -> (function(dv) -> xr.DataArray, persist in the sidecar file)
+DERIVED_VARIABLES = {}
+# per-trajectory statistics available for any variable along 'obs' as `<variable>_<statistic>`
+TRAJ_STATISTICS = {'mean': nanmean, 'std': nanstd}
+
+
+def register_derived(name, persist=True):
+    '''
+    Register a derived variable computed by function(dv), where dv is the derived_variables
+    instance giving access to the dataset (dv.ds) and to the other variables (dv[name])
+
+    :param persist: store the variable in the sidecar file (False for cheap or complex variables)
+    '''
+    def decorator(function):
+        DERIVED_VARIABLES[name] = (function, persist)
+        return function
+    return decorator
+
+
+@register_derived('speed')
+def _speed(dv):
+    return xr.DataArray(np.hypot(dv['ve'].values, dv['vn'].values), dims=['obs'], attrs={'long_name': 'Speed', 'units': 'm/s'})
+
+
+@register_derived('cv', persist=False)  # complex numbers can't be stored in netCDF
+def _complex_velocity(dv):
+    return xr.DataArray(dv['ve'].values + 1j * dv['vn'].values, dims=['obs'], attrs={'long_name': 'Complex velocity ve + i vn', 'units': 'm/s'})
+
+
+@register_derived('inertial_frequency')
+def _inertial_frequency(dv):
+    # sine of the mean latitude, as np.sin(np.radians(lat).mean()) in the notebook (not the mean of the sines)
+    seconds_per_day = 60 * 60 * 24
+    values = -2 * OMEGA * (seconds_per_day / (2 * np.pi)) * np.sin(np.radians(dv['lat_mean'].values))
+    return xr.DataArray(values, dims=['traj'], attrs={'long_name': 'Inertial frequency at the mean latitude of the trajectory', 'units': 'cpd'})
+
+
+class derived_variables:
+    def __init__(self, ds: xr.Dataset, max_bytes=2**30, sidecar=None, checksum=True):
+        '''
+        Derived variables of a ragged array, computed once on first access and memoized
+
+        The variables are kept in memory up to max_bytes (the least recently used are evicted)
+        and, if sidecar is set, stored in a netCDF file tagged with the hash of the source file
+        of ds, so they are also reused between sessions as long as the source is unchanged.
+
+        Available: the variables of DERIVED_VARIABLES (speed, cv, inertial_frequency, ...),
+        the per-trajectory statistics `<variable>_mean` and `<variable>_std` and the anomalies
+        from the trajectory mean `<variable>_anomaly` of any variable along 'obs'.
+
+        :param ds: ragged array xr.Dataset
+               max_bytes: maximum size of the variables kept in memory
+               sidecar: netCDF file of the persisted variables (True: `<source>.derived.nc`)
+               checksum: identify the source with its sha256 (otherwise its size and modification time)
+        '''
+        self.ds = ds
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()
+        self.nbytes = 0
+
+        source = ds.encoding.get('source')
+        if sidecar and source is None:
+            raise ValueError('The sidecar file requires a dataset opened from a file.')
+        if sidecar is True:
+            sidecar = f'{os.path.splitext(source)[0]}.derived.nc'
+        self.sidecar = sidecar
+        self.source_key = None
+        if sidecar:
+            signature = file_signature(source, checksum)
+            self.source_key = signature['sha256'] if checksum else f"{signature['size']}-{signature['mtime']}"
+
+    def __getitem__(self, name) -> xr.DataArray:
+        if name in self.ds.variables:
+            return self.ds[name]
+        if name in self.cache:
+            self.cache.move_to_end(name)
+            return self.cache[name]
+
+        da = self.read_sidecar(name)
+        if da is None:
+            function, persist = self.resolve(name)
+            da = function(self)
+            if persist:
+                self.write_sidecar(name, da)
+        self.store(name, da)
+        return da
+
+    def __contains__(self, name):
+        if name in self.ds.variables:
+            return True
+        try:
+            self.resolve(name)
+        except KeyError:
+            return False
+        return True
+
+    def resolve(self, name):
+        '''
+        Function computing the derived variable name and whether it is persisted
+        (KeyError if name is unknown or derived from a variable that does not exist)
+        '''
+        if name in DERIVED_VARIABLES:
+            return DERIVED_VARIABLES[name]
+        base, _, suffix = name.rpartition('_')
+        if base and base not in self:
+            raise KeyError(f'Unknown derived variable: {name} ({base} does not exist)')
+        if base and suffix in TRAJ_STATISTICS:
+            kernel = TRAJ_STATISTICS[suffix]
+            return lambda dv: xr.DataArray(
+                ragged_reduce(kernel, dv.ds.rowsize.values, dv[base].values),
+                dims=['traj'], attrs={'long_name': f'Trajectory {suffix} of {base}', 'units': dv[base].attrs.get('units', '-')},
+            ), True
+        if base and suffix == 'anomaly':
+            return lambda dv: xr.DataArray(
+                ragged_transform(anomaly, dv.ds.rowsize.values, dv[base].values),
+                dims=['obs'], attrs={'long_name': f'Anomaly of {base} from the trajectory mean', 'units': dv[base].attrs.get('units', '-')},
+            ), True
+        raise KeyError(f'Unknown derived variable: {name}')
+
+    def store(self, name, da):
+        self.cache[name] = da
+        self.nbytes += da.nbytes
+        while self.nbytes > self.max_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def read_sidecar(self, name):
+        if not self.sidecar or not os.path.isfile(self.sidecar):
+            return None
+        with xr.open_dataset(self.sidecar) as sidecar:
+            if sidecar.attrs.get('source_key') != self.source_key or name not in sidecar:
+                return None
+            return sidecar[name].load()
+
+    def write_sidecar(self, name, da):
+        if not self.sidecar:
+            return
+        valid = False
+        if os.path.isfile(self.sidecar):
+            with xr.open_dataset(self.sidecar) as sidecar:
+                valid = sidecar.attrs.get('source_key') == self.source_key
+        # a sidecar of another version of the source is replaced
+        xr.Dataset({name: da}, attrs={'source_key': self.source_key}).to_netcdf(self.sidecar, mode='a' if valid else 'w')
+
+    def assign(self, *names) -> xr.Dataset:
+        '''
+        Dataset with the derived variables names added, e.g. dv.assign('cv', 'speed')
+        '''
+        return self.ds.assign({name: self[name] for name in names})
+
+    def clear(self):
+        '''
+        Empty the memory cache (the sidecar file is kept)
+        '''
+        self.cache.clear()
+        self.nbytes = 0
@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import xarray as xr
+from preprocess import decode_date, fill_values, FILL_VALUE, create_ragged_array, create_ak, create_index, query_region
+from analysis import binned_statistics, ragged_periodogram
+
+
+def timeit(func, *args, repeat=20):
+    '''
+    Best elapsed time of `repeat` calls of func(*args)
+    '''
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def legacy_decode(t, sst, out_time, out_sst):
+    '''
+    Per-file decoding as done before the fused kernels (np.isclose + pd.to_datetime)
+    '''
+    t = t.copy()
+    nat_index = np.logical_or(np.isclose(t, FILL_VALUE), np.isnan(t))
+    t[nat_index] = np.datetime64('NaT')
+    out_time[:] = pd.to_datetime(t, unit='s', origin='unix')
+    for var, out in zip(sst, out_sst):
+        var = var.copy()
+        missing_value = np.logical_or(np.isclose(var, FILL_VALUE), ~np.isfinite(var))
+        if np.any(missing_value):
+            var[missing_value] = np.nan
+        out[:] = var
+
+
+def fused_decode(t, sst, out_time, out_sst):
+    '''
+    Per-file decoding written directly in the preallocated slices
+    '''
+    decode_date(t, out=out_time)
+    for var, out in zip(sst, out_sst):
+        fill_values(var, out=out)
+
+
+def bench_decode(sizes=(100, 1000, 10000, 100000), repeat=20, seed=42):
+    '''
+    Micro-benchmark of the decoding of `time` and the six sst variables of one file
+
+    :param sizes: number of observations of the synthetic trajectories
+    :return: pd.DataFrame of the per-file cost [s] before (legacy) and after (fused)
+    '''
+    rng = np.random.default_rng(seed)
+    results = []
+    for size in sizes:
+        t = 1e9 + 3600.0 * np.arange(size)
+        t[rng.random(size) < 0.01] = FILL_VALUE
+        sst = [290 + rng.standard_normal(size).astype('float32') for _ in range(6)]
+        for var in sst:
+            var[rng.random(size) < 0.05] = FILL_VALUE
+
+        out_time = np.zeros(size, dtype='datetime64[s]')
+        out_sst = [np.zeros(size, dtype='float32') for _ in range(6)]
+        fused_decode(t, sst, out_time, out_sst)  # jit compilation
+
+        legacy = timeit(legacy_decode, t, sst, out_time, out_sst, repeat=repeat)
+        fused = timeit(fused_decode, t, sst, out_time, out_sst, repeat=repeat)
+        results.append({'obs': size, 'legacy [s]': legacy, 'fused [s]': fused, 'speedup': legacy / fused})
+
+    return pd.DataFrame(results).set_index('obs')
+
+
+# values of the string attributes of the synthetic files (low cardinality, as in the GDP metadata)
+SYNTHETIC_ATTRIBUTES = {
+    'DeployingShip': ['MAERSK PLACENTIA', 'R/V Ronald H. Brown', 'NOAA Ship Oscar Dyson', 'Unknown'],
+    'DeploymentStatus': ['good', 'fair', ''],
+    'BuoyTypeManufacturer': ['Technocean', 'Pacific Gyre', 'Metocean', 'Clearwater', 'Scripps'],
+    'BuoyTypeSensorArray': ['SVP', 'SVPB', 'SVPBW', 'SVPC'],
+    'PurchaserFunding': ['United States', 'France', 'Canada'],
+    'SensorUpgrade': ['', 'none', 'barometer'],
+    'Transmissions': ['United States', 'ARGOS', 'IRIDIUM'],
+    'DeployingCountry': ['United States', 'France', 'South Africa', 'Australia', 'Japan'],
+    'DeploymentComments': ['', 'deployed from the stern', 'launched in heavy seas'],
+    'ManufactureSensorType': ['SVP', 'SST', ''],
+    'DrogueType': ['HOLY098', 'HOLEY SOCK', 'TRISTAR'],
+    'DrogueDetectSensor': ['submergence', 'tether strain', ''],
+}
+
+
+def synthetic_rowsize(nb_drifters, mean_length=2000, sigma=1.0, seed=42) -> np.ndarray:
+    '''
+    Number of observations of each synthetic drifter, drawn from a lognormal distribution
+    (a few long-lived drifters and many short ones, as in the GDP)
+
+    :param nb_drifters: number of drifters
+           mean_length: mean number of observations (hourly) per drifter
+           sigma: spread of the distribution (0: all the drifters have mean_length observations)
+    :return: int array of lengths (at least 2)
+    '''
+    rng = np.random.default_rng(seed)
+    length = rng.lognormal(np.log(mean_length) - sigma**2 / 2, sigma, nb_drifters)
+    return np.maximum(2, np.round(length)).astype('int64')
+
+
+def synthetic_drifter(filename, id, size, rng):
+    '''
+    Write one synthetic drifter file with the layout of the GDP hourly files: variables along
+    ['traj', 'obs'] with a singleton 'traj', -1e+34 for missing values and the metadata
+    stored in string attributes (e.g. '4.8 m')
+    '''
+    t0 = 631152000.0 + 3600 * rng.integers(0, 24 * 365 * 30)  # 1990-2020
+    t = t0 + 3600.0 * np.arange(size)
+    end = t[-1]
+
+    # random walk in position and velocity
+    ve = np.cumsum(rng.normal(0, 0.02, size)) + rng.normal(0, 0.2)
+    vn = np.cumsum(rng.normal(0, 0.02, size)) + rng.normal(0, 0.2)
+    lat = np.clip(rng.uniform(-70, 70) + np.cumsum(vn) * 3600 / 111e3, -89.9, 89.9)
+    lon = (rng.uniform(-180, 180) + np.cumsum(ve) * 3600 / 111e3 / np.cos(np.radians(lat)) + 180) % 360 - 180
+    sst = 300 - 0.3 * np.abs(lat) + rng.normal(0, 0.2, size)
+    sst[rng.random(size) < 0.1] = FILL_VALUE
+    drogue_lost = t0 + 3600 * rng.integers(0, size) if rng.random() < 0.7 else FILL_VALUE
+
+    def traj(value, dtype):
+        return ['traj'], np.array([value], dtype=dtype)
+
+    def obs(values, dtype='float32'):
+        return ['traj', 'obs'], np.asarray(values, dtype=dtype)[None]
+
+    ds = xr.Dataset(
+        data_vars=dict(
+            ID=traj(str(id), 'S10'),
+            rowsize=traj(size, 'int32'),
+            WMO=traj(rng.integers(1000000, 9999999), 'float64'),
+            expno=traj(rng.integers(1, 10000), 'float64'),
+            deploy_date=traj(t0, 'float32'),
+            deploy_lat=traj(lat[0], 'float64'),
+            deploy_lon=traj(lon[0], 'float64'),
+            end_date=traj(end, 'float32'),
+            end_lat=traj(lat[-1], 'float64'),
+            end_lon=traj(lon[-1], 'float64'),
+            drogue_lost_date=traj(drogue_lost, 'float32'),
+            typedeath=traj(rng.integers(0, 7), 'float64'),
+            typebuoy=traj(rng.choice(['SVP', 'SVPB', 'SVPBW']), 'S10'),
+            longitude=obs(lon),
+            latitude=obs(lat),
+            time=obs(t, 'float64'),
+            ve=obs(ve),
+            vn=obs(vn),
+            err_lat=obs(rng.uniform(0, 0.01, size)),
+            err_lon=obs(rng.uniform(0, 0.01, size)),
+            err_ve=obs(rng.uniform(0, 0.01, size)),
+            err_vn=obs(rng.uniform(0, 0.01, size)),
+            gap=obs(rng.choice([0, 3600, 7200], size)),
+            sst=obs(sst, 'float64'),
+            sst1=obs(np.where(sst == FILL_VALUE, FILL_VALUE, sst - 0.1), 'float64'),
+            sst2=obs(np.where(sst == FILL_VALUE, FILL_VALUE, 0.1), 'float64'),
+            err_sst=obs(np.where(sst == FILL_VALUE, FILL_VALUE, 0.05), 'float64'),
+            err_sst1=obs(np.where(sst == FILL_VALUE, FILL_VALUE, 0.05), 'float64'),
+            err_sst2=obs(np.where(sst == FILL_VALUE, FILL_VALUE, 0.01), 'float64'),
+            flg_sst=obs(np.where(sst == FILL_VALUE, 0, 5), 'float64'),
+            flg_sst1=obs(np.where(sst == FILL_VALUE, 0, 5), 'float64'),
+            flg_sst2=obs(np.where(sst == FILL_VALUE, 0, 5), 'float64'),
+        ),
+        attrs=dict(
+            {name: rng.choice(values) for name, values in SYNTHETIC_ATTRIBUTES.items()},
+            location_type=rng.choice(['Argos', 'GPS']),
+            CurrentProgram=str(rng.integers(1000, 9999)),
+            ManufactureYear=rng.choice(['NaN', str(rng.integers(1990, 2020))]),
+            ManufactureMonth=rng.choice(['NaN', str(rng.integers(1, 13))]),
+            ManufactureVoltage=rng.choice(['56 V', '56 volts', '']),
+            FloatDiameter=f'{rng.choice([35.5, 38, 40])} cm',
+            SubsfcFloatPresence=rng.choice(['0', '1']),
+            DrogueLength=f'{rng.choice([4.8, 5.5, 6.1])} m',
+            DrogueBallast=f'{rng.choice([1.4, 2])} kg',
+            DragAreaAboveDrogue=f'{rng.uniform(10, 20):.4g} m^2',
+            DragAreaOfDrogue=f'{rng.uniform(400, 800):.4g} m^2',
+            DragAreaRatio=f'{rng.uniform(30, 50):.6g}',
+            DrogueCenterDepth=f'{rng.choice([15, 15.0])} m',
+        ),
+    )
+    ds.time.attrs['units'] = 'seconds since 1970-01-01 00:00:00 UTC'
+    # the -1e+34 values are written as is (no _FillValue), as in the GDP files
+    ds.to_netcdf(filename, encoding={var: {'_FillValue': None} for var in ds.variables})
+
+
+def generate_drifters(folder, nb_drifters=100, mean_length=2000, sigma=1.0, rowsize=None, seed=42) -> list:
+    '''
+    Generate a set of synthetic drifter files (see synthetic_drifter), fully offline
+
+    :param folder: output folder
+           nb_drifters: number of files
+           mean_length, sigma: distribution of the number of observations (see synthetic_rowsize)
+           rowsize: explicit number of observations of each drifter (overrides the distribution)
+           seed: random seed (the same parameters always give the same files)
+    :return: list of filenames
+    '''
+    os.makedirs(folder, exist_ok=True)
+    if rowsize is None:
+        rowsize = synthetic_rowsize(nb_drifters, mean_length, sigma, seed)
+    rng = np.random.default_rng(seed)
+    files = []
+    for i, size in enumerate(rowsize):
+        filename = os.path.join(folder, f'drifter_{i}.nc')
+        synthetic_drifter(filename, 300000 + i, int(size), rng)
+        files.append(filename)
+    return files
+
+
+def measure(func, *args, repeat=1):
+    '''
+    Best elapsed time of `repeat` calls of func(*args) and peak memory allocated during one
+    extra call. The time is measured without tracemalloc, which slows down the allocations.
+
+    :return: elapsed time [s], peak memory [bytes], result of the last call
+    '''
+    elapsed = timeit(func, *args, repeat=repeat)
+    tracemalloc.start()
+    result = func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def bench_workflows(scales=(100, 1000), mean_length=2000, sigma=1.0, workers=1, repeat=3, folder=None, seed=42):
+    '''
+    Benchmark of the typical workflow on synthetic drifters: ingestion of the files, conversion
+    to xarray and Awkward Array, binning, region extraction and periodograms
+
+    :param scales: numbers of drifters
+           mean_length, sigma: distribution of the number of observations (see synthetic_rowsize)
+           workers: number of processes used for the ingestion (peak memory is only measured in
+                    the main process)
+           repeat: number of timed calls of each stage (the ingestion is timed once), the peak
+                   memory is measured in one more call (see measure)
+           folder: where the files are generated (default: temporary folder)
+    :return: pd.DataFrame of the elapsed time, throughput and peak memory per scale and stage
+    '''
+    bins = [np.linspace(-180, 180, 361), np.linspace(-90, 90, 181)]
+    results = []
+
+    def run(nb_drifters, path):
+        files = generate_drifters(os.path.join(path, str(nb_drifters)), nb_drifters, mean_length, sigma, seed=seed)
+        stages = {}
+        stages['ingestion'] = measure(lambda: create_ragged_array(files, workers=workers))
+        ra = stages['ingestion'][2]
+        stages['to_xarray'] = measure(ra.to_xarray, repeat=repeat)
+        ds = stages['to_xarray'][2]
+        stages['create_ak'] = measure(create_ak, ds, repeat=repeat)
+        stages['binning'] = measure(lambda: binned_statistics(ds.lon.values, ds.lat.values, ds.ve.values, bins), repeat=repeat)
+        stages['index'] = measure(create_index, ds, repeat=repeat)
+        index = stages['index'][2]
+        stages['region'] = measure(lambda: query_region(ds, index, lon=[-98, -78], lat=[18, 31]), repeat=repeat)
+        stages['periodogram'] = measure(lambda: ragged_periodogram(ds.rowsize.values, ds.ve.values, ds.vn.values), repeat=repeat)
+        return len(files), ra.nb_obs, stages
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = folder or tmp
+        run(2, path)  # jit compilation
+        for nb_drifters in scales:
+            nb_files, nb_obs, stages = run(nb_drifters, path)
+            for stage, (elapsed, peak, _) in stages.items():
+                results.append({
+                    'drifters': nb_files, 'obs': nb_obs, 'stage': stage, 'time [s]': elapsed,
+                    'obs/s': nb_obs / elapsed, 'peak memory [MB]': peak / 2**20,
+                })
+
+    return pd.DataFrame(results).set_index(['drifters', 'stage'])
+
+
+def save_baseline(results, filename):
+    '''
+    Store the results of bench_workflows as the reference of later runs
+    '''
+    with open(filename, 'w') as f:
+        json.dump(results.reset_index().to_dict(orient='records'), f, indent=1)
+
+
+def compare_baseline(results, filename) -> pd.DataFrame:
+    '''
+    Add the baseline time and the speedup (baseline / current) of each scale and stage
+    '''
+    with open(filename) as f:
+        baseline = pd.DataFrame(json.load(f)).set_index(['drifters', 'stage'])
+    results = results.copy()
+    results['baseline [s]'] = baseline['time [s]'].reindex(results.index)
+    results['speedup'] = results['baseline [s]'] / results['time [s]']
+    return results
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks on synthetic drifter files')
+    parser.add_argument('--scales', type=int, nargs='+', default=[100, 1000], help='numbers of drifters')
+    parser.add_argument('--mean-length', type=int, default=2000, help='mean number of observations per drifter')
+    parser.add_argument('--sigma', type=float, default=1.0, help='spread of the lognormal distribution of the lengths')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used for the ingestion')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline results (json) to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--decode', action='store_true', help='only run the micro-benchmark of the decoding')
+    args = parser.parse_args()
+
+    if args.decode:
+        print(bench_decode())
+        sys.exit()
+
+    results = bench_workflows(args.scales, args.mean_length, args.sigma, args.workers)
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+    elif os.path.exists(args.baseline):
+        results = compare_baseline(results, args.baseline)
+
+    with pd.option_context('display.width', 200, 'display.max_columns', 20):
+        print(results)
@@ -0,0 +1,288 @@
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import tempfile
+import warnings
+import threading
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from preprocess import file_signature, create_ragged_array
+
+
+GDP_URL = 'https://www.aoml.noaa.gov/ftp/pub/phod/lumpkin/hourly/v2.00/netcdf/'
+MANIFEST = 'manifest.json'  # name of the manifest of the downloaded files in the output folder
+LISTING = 'listing.json'  # cached list of the files available on the server
+
+# errors worth retrying (the server or the network may recover)
+RETRY_ERRORS = (OSError, http.client.HTTPException)
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+_local = threading.local()  # connections of each thread, reused between requests
+_opened = set()  # all the connections, closed by close_connections()
+_lock = threading.Lock()
+
+
+class FetchError(Exception):
+    def __init__(self, message, retry=False):
+        '''
+        Unexpected response of the server (retry: the error may be temporary, e.g. HTTP 503)
+        '''
+        super().__init__(message)
+        self.retry = retry
+
+
+def _connection(url, timeout):
+    '''
+    Persistent connection of the current thread to the host of url
+    '''
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    connections = _local.__dict__.setdefault('connections', {})
+    if key not in connections:
+        if parts.scheme == 'https':
+            connections[key] = http.client.HTTPSConnection(parts.netloc, timeout=timeout)
+        else:
+            connections[key] = http.client.HTTPConnection(parts.netloc, timeout=timeout)
+        with _lock:
+            _opened.add(connections[key])
+    return connections[key]
+
+
+def _close_connection(url):
+    parts = urlsplit(url)
+    connection = _local.__dict__.get('connections', {}).pop((parts.scheme, parts.netloc), None)
+    if connection is not None:
+        connection.close()
+        with _lock:
+            _opened.discard(connection)
+
+
+def close_connections():
+    '''
+    Close the persistent connections of all the threads
+    '''
+    with _lock:
+        for connection in _opened:
+            connection.close()
+        _opened.clear()
+
+
+def _request(url, headers=None, timeout=60):
+    '''
+    GET request on the persistent connection of the current thread
+    (the response must be read completely before the next request)
+    '''
+    parts = urlsplit(url)
+    path = parts.path + (f'?{parts.query}' if parts.query else '')
+    connection = _connection(url, timeout)
+    try:
+        connection.request('GET', path, headers=headers or {})
+        return connection.getresponse()
+    except RETRY_ERRORS:
+        _close_connection(url)  # e.g. closed by the server after being idle
+        raise
+
+
+def _retry(func, retries=3, backoff=0.5):
+    '''
+    Call func() and retry on network errors with exponential backoff (and jitter)
+    '''
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except (FetchError,) + RETRY_ERRORS as e:
+            if attempt == retries or (isinstance(e, FetchError) and not e.retry):
+                raise
+            time.sleep(backoff * 2**attempt * (1 + random.random()))
+
+
+def list_files(url=GDP_URL, folder=None, max_age=86400, pattern=r'drifter_[0-9]*\.nc', timeout=60) -> list:
+    '''
+    Names of the files available on the server, scraped from the directory listing
+
+    :param url: url of the folder on the server
+           folder: if set, the listing is cached in folder/listing.json and reused for max_age seconds
+           pattern: regular expression of the file names
+    :return: sorted list of file names
+    '''
+    cache = os.path.join(folder, LISTING) if folder else None
+    if cache and os.path.isfile(cache):
+        with open(cache) as f:
+            listing = json.load(f)
+        if listing['url'] == url and time.time() - listing['time'] < max_age:
+            return listing['files']
+
+    def get():
+        response = _request(url, timeout=timeout)
+        body = response.read()
+        if response.status != 200:
+            raise FetchError(f'{url}: HTTP {response.status}', response.status in RETRY_STATUS)
+        return body.decode('utf-8')
+
+    files = sorted(set(re.findall(pattern, _retry(get))))
+    if cache:
+        os.makedirs(folder, exist_ok=True)
+        write_json(cache, {'url': url, 'time': time.time(), 'files': files})
+    return files
+
+
+def write_json(filename, content):
+    '''
+    Write a json file atomically (temporary file renamed once complete)
+    '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(content, f, indent=1)
+    os.replace(tmp, filename)
+
+
+def read_json(filename, default=None):
+    if not os.path.isfile(filename):
+        return default
+    with open(filename) as f:
+        return json.load(f)
+
+
+def verify(file, entry, checksum=False) -> bool:
+    '''
+    Check that the local file corresponds to its manifest entry (size and modification
+    time, or sha256 if checksum is True)
+    '''
+    if entry is None or not os.path.isfile(file):
+        return False
+    signature = file_signature(file, checksum)
+    if signature['size'] != entry['size']:
+        return False
+    if checksum:
+        return signature['sha256'] == entry['sha256']
+    return signature['mtime'] == entry['mtime']
+
+
+def download(url, file, entry=None, checksum=False, revalidate=True, retries=3, backoff=0.5, timeout=60) -> dict:
+    '''
+    Download one file, unless the local copy is valid and has not changed on the server
+
+    The file is written to a temporary file in the same folder and renamed once its size
+    is verified, so an interrupted download never leaves a partial file at `file`.
+
+    :param url: url of the file
+           file: local path
+           entry: manifest entry of the previous download of file (None if unknown)
+           checksum: verify the local copy with its sha256 (instead of its size and time)
+           revalidate: ask the server whether a valid local copy has changed (conditional request
+                       on the ETag and Last-Modified); if False it is reused without any request
+           retries, backoff: number of retries on network errors and initial delay [s] between them
+    :return: manifest entry of the file (url, size, etag, last_modified, sha256, mtime) with
+             'status': 'downloaded', 'unchanged' or 'cached'
+    '''
+    valid = verify(file, entry, checksum)
+    if valid and not revalidate:
+        return dict(entry, status='cached')
+
+    headers = {}
+    if valid and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if valid and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    def get():
+        response = _request(url, headers, timeout)
+        if response.status == 304:
+            response.read()
+            return dict(entry, status='unchanged')
+        if response.status != 200:
+            response.read()
+            raise FetchError(f'{url}: HTTP {response.status}', response.status in RETRY_STATUS)
+
+        h = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file)), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in iter(lambda: response.read(1 << 20), b''):
+                    f.write(block)
+                    h.update(block)
+                    size += len(block)
+            length = response.getheader('Content-Length')
+            if length is not None and int(length) != size:
+                raise http.client.IncompleteRead(b'', int(length) - size)
+            os.replace(tmp, file)
+        except BaseException:
+            os.remove(tmp)
+            _close_connection(url)  # the rest of the response is lost
+            raise
+
+        return {
+            'url': url, 'size': size, 'sha256': h.hexdigest(), 'mtime': os.stat(file).st_mtime,
+            'etag': response.getheader('ETag'), 'last_modified': response.getheader('Last-Modified'),
+            'status': 'downloaded',
+        }
+
+    return _retry(get, retries, backoff)
+
+
+def fetch(names, folder, url=GDP_URL, workers=8, checksum=False, revalidate=True, retries=3, backoff=0.5, timeout=60) -> list:
+    '''
+    Download the trajectory files to folder with a bounded number of concurrent connections
+    (reused between files). The files already downloaded and unchanged are skipped, see download().
+
+    The manifest of the downloaded files (folder/manifest.json) is updated as the downloads
+    complete, so an interrupted run resumes where it stopped.
+
+    :param names: file names (e.g. ['drifter_101143.nc']) or drifter IDs
+           folder: output folder
+           url: url of the folder on the server
+           workers: maximum number of concurrent downloads
+    :return: list of the verified local files (same order as names, failed downloads are
+             excluded and reported in a warning)
+    '''
+    os.makedirs(folder, exist_ok=True)
+    names = [name if isinstance(name, str) else f'drifter_{name}.nc' for name in names]
+    manifest_file = os.path.join(folder, MANIFEST)
+    manifest = read_json(manifest_file, default={})
+    base = url.rstrip('/') + '/'
+
+    def fetch_one(name):
+        try:
+            return name, download(base + name, os.path.join(folder, name), manifest.get(name),
+                                  checksum, revalidate, retries, backoff, timeout)
+        except Exception as e:
+            return name, e
+
+    files, failed = {}, {}
+    last_save = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for name, result in tqdm(executor.map(fetch_one, names), total=len(names)):
+            if isinstance(result, Exception):
+                failed[name] = repr(result)
+                continue
+            status = result.pop('status')
+            files[name] = os.path.join(folder, name)
+            if status != 'cached':
+                manifest[name] = result
+            if time.monotonic() - last_save > 5:
+                write_json(manifest_file, manifest)
+                last_save = time.monotonic()
+    close_connections()
+    write_json(manifest_file, manifest)
+
+    if failed:
+        warnings.warn(f'{len(failed)} file(s) could not be downloaded: {failed}')
+    return [files[name] for name in names if name in files]
+
+
+def fetch_ragged_array(names, folder, url=GDP_URL, download_workers=8, checksum=False, revalidate=True, **kwargs):
+    '''
+    Download the trajectory files (see fetch) and build the ragged array from the verified files
+
+    :param download_workers: maximum number of concurrent downloads
+           kwargs: arguments of create_ragged_array (workers, path, batch_size, profile, variables)
+    :return: create_ragged_array
+    '''
+    files = fetch(names, folder, url, download_workers, checksum, revalidate)
+    return create_ragged_array(files, **kwargs)
@@ -1,64 +1,193 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import warnings
+import functools
+import itertools
+import contextlib
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import xarray as xr
+import netCDF4 as nc
 import numpy as np
 from datetime import datetime
 import pandas as pd
 import awkward as ak
+import pyarrow as pa
+import pyarrow.parquet as pq
+import numba as nb
 from tqdm import tqdm
 
 
-def decode_date(t):
+FILL_VALUE = -1e+34  # missing values of the GDP files
+NAT = np.iinfo('int64').min  # integer representation of NaT
+
+
+@nb.njit(cache=True, nogil=True)
+def _is_fill_value(x):
+    # same tolerances as np.isclose(x, FILL_VALUE)
+    return abs(x - FILL_VALUE) <= 1e-08 + 1e-05 * abs(FILL_VALUE)
+
+
+@nb.njit(cache=True, nogil=True)
+def _decode_date_kernel(t, out):
+    for i in range(len(t)):
+        x = t[i]
+        if not np.isfinite(x) or _is_fill_value(x):
+            out[i] = NAT
+        else:
+            # round to the nanosecond (as pd.to_datetime) and floor to the second (as datetime64[s])
+            sec = np.int64(x)
+            ns = sec * 1000000000 + np.int64(np.round((x - sec) * 1e9))
+            out[i] = ns // 1000000000
+
+
+@nb.njit(cache=True, nogil=True)
+def _fill_values_kernel(var, out, default):
+    for i in range(len(var)):
+        x = var[i]
+        if not np.isfinite(x) or _is_fill_value(x):
+            out[i] = default
+        else:
+            out[i] = x
+
+
+def decode_date(t, out=None):
     '''
     The date format is specified in 'seconds since 1970-01-01 00:00:00' but the missing values
     are stored as -1e+34 which is not supported by the default parsing mechanism in xarray
 
     This function returns replaced the missing valye by NaT and return a datetime object.
     :param t: date
+           out: datetime64[s] array where the decoded vector is written (in a single pass)
     :return: datetime object
     '''
     if np.isscalar(t):
-        if np.isclose(t, -1e+34) or np.isnan(t):
+        if np.isclose(t, FILL_VALUE) or np.isnan(t):
             return np.datetime64('NaT')
         else:
             return pd.to_datetime(t, unit='s', origin='unix')
     else:
-        nat_index = np.logical_or(np.isclose(t, -1e+34), np.isnan(t))
-        t[nat_index] = np.datetime64('NaT')
-        return pd.to_datetime(t, unit='s', origin='unix')
+        if out is None:
+            out = np.empty(len(t), dtype='datetime64[s]')
+        _decode_date_kernel(np.asarray(t, dtype='float64'), out.view('int64'))
+        return out
 
 
-def fill_values(var, default=np.nan):
+def fill_values(var, default=np.nan, out=None):
     '''
     Change fill values (-1e+34, inf, -inf) in var array to value specified by default
+    :param var: array
+           default: replacement value
+           out: array where the result is written (default: var is modified in place)
     '''
-    missing_value = np.logical_or(np.isclose(var, -1e+34), ~np.isfinite(var))
-    if np.any(missing_value):
-        var[missing_value] = default
-    return var
+    if out is None:
+        out = var
+    _fill_values_kernel(var, out, default)
+    return out
+
+
+# pattern of the numerical attributes: a number optionally followed by a unit (e.g. '4.8 m', '416.6 m^2')
+QUANTITY_PATTERN = r'^\s*(?P<value>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|[nN][aA][nN])\s*(?P<unit>.*?)\s*$'
 
 
-def str_to_float(value, default=np.nan):
+# spellings of the units found in the attributes (lower case): unit
+UNIT_ALIASES = {
+    'v': 'V', 'volt': 'V', 'volts': 'V', 'v/day': 'V',  # ManufactureVoltage, e.g. '56 V/day'
+    'centimeters': 'cm', 'meters': 'm', 'kilograms': 'kg', 'm2': 'm^2',
+}
+
+
+def parse_quantity(values, unit=None, default=np.nan):
     '''
-    :param value: string
-    :return: bool
+    Vectorized conversion of string attributes (e.g. '4.8 m') to numbers
+
+    The unit of each value must be the expected unit or one of its spellings (see UNIT_ALIASES),
+    the values with another unit (e.g. '35 mm' for a diameter in cm) are set to default.
+
+    :param values: array of strings
+           unit: expected unit (None: unitless)
+           default: value for the missing, unparsable values and the values with an unexpected unit
+    :return: numbers: float array
+             report: dict with the number of missing and failed values, the failed strings,
+                     the count of each unit found and the values with an unexpected unit
     '''
-    try:
-        fvalue = float(value)
-        if np.isnan(fvalue):
-            return default
-        else:
-            return fvalue
-    except ValueError:
-        return default
+    values = pd.Series(values, dtype='object').fillna('').astype('str').str.strip()
+    parts = values.str.extract(QUANTITY_PATTERN)
+    numbers = pd.to_numeric(parts['value'], errors='coerce')
 
+    missing = (values == '') | (parts['value'].notna() & numbers.isna())  # empty or 'NaN'
+    failed = ~missing & parts['value'].isna()
+    parsed = parts['value'].notna() & ~missing
+    units = parts['unit'][parsed]
+    unexpected = parsed & (parts['unit'].str.lower().map(UNIT_ALIASES).fillna(parts['unit']) != (unit or ''))
 
-def cut_str(value, max_length):
+    report = {
+        'missing': int(missing.sum()),
+        'failed': int(failed.sum()),
+        'failed_values': sorted(values[failed].unique().tolist()),
+        'units': units.value_counts().to_dict(),
+        'unexpected_units': int(unexpected.sum()),
+        'unexpected_values': sorted(values[unexpected].unique().tolist()),
+    }
+    return numbers.mask(unexpected).fillna(default).to_numpy(), report
+
+
+def categorical(values):
     '''
-    Cut a string to a specify lenth.
-    :param value: string
-           max_length: lenght of the output
-    :return: string with max_length chars
+    Dictionary encoding of string values (e.g. the deployment country of each trajectory)
+
+    :param values: array of strings (bytes are decoded as utf-8)
+    :return: codes: smallest signed integer array indexing categories
+             categories: sorted array of the distinct strings
     '''
-    return value[:max_length]
+    values = pd.Series(values, dtype='object').fillna('')
+    values = values.map(lambda v: v.decode('utf-8', 'ignore') if isinstance(v, bytes) else str(v))
+    codes, categories = pd.factorize(values, sort=True)
+    return codes.astype(np.min_scalar_type(-max(len(categories), 1))), np.asarray(categories, dtype='str')
+
+
+def categorical_attrs(categories) -> dict:
+    '''
+    Attributes describing the categories of a dictionary encoded variable. flag_values and
+    flag_meanings follow the CF conventions (unique words of the characters [A-Za-z0-9_.+@-],
+    '_<code>' is added to a meaning already used), the exact values are kept in 'categories'.
+    '''
+    meanings, used = [], set()
+    for code, c in enumerate(categories):
+        meaning = re.sub(r'[^A-Za-z0-9_.+@-]', '_', '_'.join(c.split())) if c else 'empty'
+        while meaning in used:
+            meaning = f'{meaning}_{code}'
+        meanings.append(meaning)
+        used.add(meaning)
+    return {
+        'flag_values': ', '.join(str(i) for i in range(len(categories))),
+        'flag_meanings': ' '.join(meanings),
+        'categories': list(categories),
+    }
+
+
+def category_table(da: xr.DataArray):
+    '''
+    Categories of a dictionary encoded variable (None if the variable is not categorical)
+    '''
+    if 'categories' not in da.attrs:
+        return None
+    # a single category is read back from netCDF as a scalar string
+    return np.asarray(np.atleast_1d(da.attrs['categories']), dtype='str')
+
+
+def decode_categorical(da: xr.DataArray) -> np.ndarray:
+    '''
+    Strings of a dictionary encoded variable, e.g. decode_categorical(ds.DeployingCountry)
+    '''
+    categories = category_table(da)
+    if categories is None:
+        return da.values
+    return categories.astype('object')[da.values]
 
 
 def drogue_presence(lost_time, time):
@@ -74,95 +203,457 @@ def drogue_presence(lost_time, time):
         return time < lost_time
 
 
+def location_system(values):
+    '''
+    Location system from the 'location_type' attribute: 0 Argos, 1 GPS
+    '''
+    return values != 'Argos'
+
+
+def ascii_categorical(values):
+    '''
+    Same as categorical() after removing the non-ascii characters
+    '''
+    values = pd.Series(values, dtype='object').fillna('').astype('str')
+    return categorical(values.str.encode('ascii', 'ignore').str.decode('ascii'))
+
+
+def quantity(unit, default=np.nan):
+    '''
+    Decoder of a numerical attribute (see parse_quantity)
+    '''
+    return functools.partial(parse_quantity, unit=unit, default=default)
+
+
+def repeat_id(data):
+    '''
+    ID of the trajectory repeated along the observations
+    '''
+    return int(data['ID'])
+
+
+def drogue_status(data):
+    '''
+    Drogue status of each observation, from the drogue lost date and the observation time
+    '''
+    lost_time = decode_date(np.atleast_1d(data['drogue_lost_date']))[0]
+    return drogue_presence(lost_time, decode_date(data['time']))
+
+
+# Declaration of one variable of the ragged array
+# name: variable of the xr.Dataset (and field of the Awkward Array)
+# attr: attribute of create_ragged_array holding the column
+# dim: 'traj' or 'obs'
+# dtype: type of the column (None: type returned by the decoder, e.g. the codes of categorical)
+# variable: source variable of the trajectory files
+# attribute: source global attribute of the trajectory files (parsed for all trajectories at once)
+# decoder: 'traj': decoder(raw values of all trajectories) -> column or (column, categories or parse report)
+#          'obs': decoder(raw vector, out=slice of the column); with requires: decoder(data) -> vector
+# requires: names of the raw values needed by a computed variable (no variable nor attribute)
+# coord: coordinate of the xr.Dataset
+# attrs: attributes of the variable (the categories are added by to_xarray)
+ragged_variable = namedtuple(
+    'ragged_variable',
+    ['name', 'attr', 'dim', 'dtype', 'variable', 'attribute', 'decoder', 'requires', 'coord', 'attrs'],
+    defaults=[None, None, None, (), False, {}],
+)
+
+# schema of the ragged array, in the order of the output (see to_xarray and create_ak)
+SCHEMA = [
+    ragged_variable('ID', 'id', 'traj', 'int64', variable='ID', coord=True, attrs={'long_name': 'Global Drifter Program Buoy ID', 'units':'-'}),
+    ragged_variable('location_type', 'location_type', 'traj', 'bool', attribute='location_type', decoder=location_system, attrs={'long_name': 'Satellite-based location system', 'units':'-', 'comments':'0 (Argos), 1 (GPS)'}),
+    ragged_variable('WMO', 'wmo', 'traj', 'int32', variable='WMO', attrs={'long_name': 'World Meteorological Organization buoy identification number', 'units':'-'}),
+    ragged_variable('expno', 'expno', 'traj', 'int32', variable='expno', attrs={'long_name': 'Experiment number', 'units':'-'}),
+    ragged_variable('deploy_date', 'deploy_date', 'traj', 'datetime64[s]', variable='deploy_date', decoder=decode_date, attrs={'long_name': 'Deployment date and time'}),
+    ragged_variable('deploy_lon', 'deploy_lon', 'traj', 'float32', variable='deploy_lon', attrs={'long_name': 'Deployment longitude', 'units':'degrees_east'}),
+    ragged_variable('deploy_lat', 'deploy_lat', 'traj', 'float32', variable='deploy_lat', attrs={'long_name': 'Deployment latitude', 'units':'degrees_north'}),
+    ragged_variable('end_date', 'end_date', 'traj', 'datetime64[s]', variable='end_date', decoder=decode_date, attrs={'long_name': 'End date and time'}),
+    ragged_variable('end_lat', 'end_lat', 'traj', 'float32', variable='end_lat', attrs={'long_name': 'End latitude', 'units':'degrees_north'}),
+    ragged_variable('end_lon', 'end_lon', 'traj', 'float32', variable='end_lon', attrs={'long_name': 'End longitude', 'units':'degrees_east'}),
+    ragged_variable('drogue_lost_date', 'drogue_lost_date', 'traj', 'datetime64[s]', variable='drogue_lost_date', decoder=decode_date, attrs={'long_name': 'Date and time of drogue loss'}),
+    ragged_variable('type_death', 'type_death', 'traj', 'int8', variable='typedeath', attrs={'long_name': 'Type of death', 'units':'-', 'comments': '0 (buoy still alive), 1 (buoy ran aground), 2 (picked up by vessel), 3 (stop transmitting), 4 (sporadic transmissions), 5 (bad batteries), 6 (inactive status)'}),
+    ragged_variable('type_buoy', 'type_buoy', 'traj', None, variable='typebuoy', decoder=categorical, attrs={'long_name': 'Buoy type (see https://www.aoml.noaa.gov/phod/dac/dirall.html)', 'units':'-'}),
+    ragged_variable('DeploymentShip', 'deployment_ship', 'traj', None, attribute='DeployingShip', decoder=categorical, attrs={'long_name': 'Name of deployment ship', 'units':'-'}),
+    ragged_variable('DeploymentStatus', 'deployment_status', 'traj', None, attribute='DeploymentStatus', decoder=categorical, attrs={'long_name': 'Deployment status', 'units':'-'}),
+    ragged_variable('BuoyTypeManufacturer', 'buoy_type_manufacturer', 'traj', None, attribute='BuoyTypeManufacturer', decoder=categorical, attrs={'long_name': 'Buoy type manufacturer', 'units':'-'}),
+    ragged_variable('BuoyTypeSensorArray', 'buoy_type_sensor_array', 'traj', None, attribute='BuoyTypeSensorArray', decoder=categorical, attrs={'long_name': 'Buoy type sensor array', 'units':'-'}),
+    ragged_variable('CurrentProgram', 'current_program', 'traj', 'int32', attribute='CurrentProgram', decoder=quantity(None, -1), attrs={'long_name': 'Current Program', 'units':'-', '_FillValue': '-1'}),
+    ragged_variable('PurchaserFunding', 'purchaser_funding', 'traj', None, attribute='PurchaserFunding', decoder=categorical, attrs={'long_name': 'Purchaser funding', 'units':'-'}),
+    ragged_variable('SensorUpgrade', 'sensor_upgrade', 'traj', None, attribute='SensorUpgrade', decoder=categorical, attrs={'long_name': 'Sensor upgrade', 'units':'-'}),
+    ragged_variable('Transmissions', 'transmissions', 'traj', None, attribute='Transmissions', decoder=categorical, attrs={'long_name': 'Transmissions', 'units':'-'}),
+    ragged_variable('DeployingCountry', 'deploying_country', 'traj', None, attribute='DeployingCountry', decoder=categorical, attrs={'long_name': 'Deploying country', 'units':'-'}),
+    ragged_variable('DeploymentComments', 'deployment_comments', 'traj', None, attribute='DeploymentComments', decoder=ascii_categorical, attrs={'long_name': 'Deployment comments', 'units':'-'}),
+    ragged_variable('ManufactureYear', 'manufacture_year', 'traj', 'int16', attribute='ManufactureYear', decoder=quantity(None, -1), attrs={'long_name': 'Manufacture year', 'units':'-', '_FillValue': '-1'}),
+    ragged_variable('ManufactureMonth', 'manufacture_month', 'traj', 'int16', attribute='ManufactureMonth', decoder=quantity(None, -1), attrs={'long_name': 'Manufacture month', 'units':'-', '_FillValue': '-1'}),
+    ragged_variable('ManufactureSensorType', 'manufacture_sensor_type', 'traj', None, attribute='ManufactureSensorType', decoder=categorical, attrs={'long_name': 'Manufacture Sensor Type', 'units':'-'}),
+    ragged_variable('ManufactureVoltage', 'manufacture_voltage', 'traj', 'int16', attribute='ManufactureVoltage', decoder=quantity('V', -1), attrs={'long_name': 'Manufacture voltage', 'units':'-', '_FillValue': '-1'}),
+    ragged_variable('FloatDiameter', 'float_diameter', 'traj', 'float32', attribute='FloatDiameter', decoder=quantity('cm'), attrs={'long_name': 'Diameter of surface floater', 'units':'cm'}),
+    ragged_variable('SubsfcFloatPresence', 'subsfc_float_presence', 'traj', 'bool', attribute='SubsfcFloatPresence', decoder=quantity(None), attrs={'long_name': 'Subsurface Float Presence', 'units':'-'}),
+    ragged_variable('DrogueType', 'drogue_type', 'traj', None, attribute='DrogueType', decoder=categorical, attrs={'long_name': 'Drogue Type', 'units':'-'}),
+    ragged_variable('DrogueLength', 'drogue_length', 'traj', 'float32', attribute='DrogueLength', decoder=quantity('m'), attrs={'long_name': 'Length of drogue.', 'units':'m'}),
+    ragged_variable('DrogueBallast', 'drogue_ballast', 'traj', 'float32', attribute='DrogueBallast', decoder=quantity('kg'), attrs={'long_name': "Weight of the drogue's ballast.", 'units':'kg'}),
+    ragged_variable('DragAreaAboveDrogue', 'drag_area_above_drogue', 'traj', 'float32', attribute='DragAreaAboveDrogue', decoder=quantity('m^2'), attrs={'long_name': 'Drag area above drogue.', 'units':'m^2'}),
+    ragged_variable('DragAreaOfDrogue', 'drag_area_drogue', 'traj', 'float32', attribute='DragAreaOfDrogue', decoder=quantity('m^2'), attrs={'long_name': 'Drag area drogue.', 'units':'m^2'}),
+    ragged_variable('DragAreaRatio', 'drag_area_ratio', 'traj', 'float32', attribute='DragAreaRatio', decoder=quantity(None), attrs={'long_name': 'Drag area ratio', 'units':'m'}),
+    ragged_variable('DrogueCenterDepth', 'drag_center_depth', 'traj', 'float32', attribute='DrogueCenterDepth', decoder=quantity('m'), attrs={'long_name': 'Average depth of the drogue.', 'units':'m'}),
+    ragged_variable('DrogueDetectSensor', 'drogue_detect_sensor', 'traj', None, attribute='DrogueDetectSensor', decoder=categorical, attrs={'long_name': 'Drogue detection sensor', 'units':'-'}),
+    ragged_variable('lon', 'lon', 'obs', 'float32', variable='longitude', coord=True, attrs={'long_name': 'Longitude', 'units':'degrees_east'}),
+    ragged_variable('lat', 'lat', 'obs', 'float32', variable='latitude', coord=True, attrs={'long_name': 'Latitude', 'units':'degrees_north'}),
+    ragged_variable('time', 'time', 'obs', 'datetime64[s]', variable='time', decoder=decode_date, coord=True, attrs={'long_name': 'Time'}),
+    ragged_variable('ids', 'ids', 'obs', 'int64', decoder=repeat_id, coord=True, requires=('ID',), attrs={'long_name': "Global Drifter Program Buoy identification number repeated along observations", 'units':'-'}),
+    ragged_variable('ve', 've', 'obs', 'float32', variable='ve', attrs={'long_name': 'Eastward velocity', 'units':'m/s'}),
+    ragged_variable('vn', 'vn', 'obs', 'float32', variable='vn', attrs={'long_name': 'Northward velocity', 'units':'m/s'}),
+    ragged_variable('gap', 'gap', 'obs', 'float32', variable='gap', attrs={'long_name': 'Time interval between previous and next location', 'units':'s'}),
+    ragged_variable('err_lat', 'err_lat', 'obs', 'float32', variable='err_lat', attrs={'long_name': '95% confidence interval in latitude', 'units':'degrees_north'}),
+    ragged_variable('err_lon', 'err_lon', 'obs', 'float32', variable='err_lon', attrs={'long_name': '95% confidence interval in longitude', 'units':'degrees_east'}),
+    ragged_variable('err_ve', 'err_ve', 'obs', 'float32', variable='err_ve', attrs={'long_name': '95% confidence interval in eastward velocity', 'units':'m/s'}),
+    ragged_variable('err_vn', 'err_vn', 'obs', 'float32', variable='err_vn', attrs={'long_name': '95% confidence interval in northward velocity', 'units':'m/s'}),
+    ragged_variable('drogue_status', 'drogue_status', 'obs', 'bool', decoder=drogue_status, requires=('drogue_lost_date', 'time'), attrs={'long_name': 'Status indicating the presence of the drogue', 'units':'-', 'flag_values':'1,0', 'flag_meanings': 'drogued, undrogued'}),
+    ragged_variable('sst', 'sst', 'obs', 'float32', variable='sst', decoder=fill_values, attrs={'long_name': 'Fitted sea water temperature', 'units':'Kelvin', 'comments': 'Estimated near-surface sea water temperature from drifting buoy measurements. It is the sum of the fitted near-surface non-diurnal sea water temperature and fitted diurnal sea water temperature anomaly. Discrepancies may occur because of rounding.'}),
+    ragged_variable('sst1', 'sst1', 'obs', 'float32', variable='sst1', decoder=fill_values, attrs={'long_name': 'Fitted non-diurnal sea water temperature', 'units':'Kelvin', 'comments': 'Estimated near-surface non-diurnal sea water temperature from drifting buoy measurements'}),
+    ragged_variable('sst2', 'sst2', 'obs', 'float32', variable='sst2', decoder=fill_values, attrs={'long_name': 'Fitted diurnal sea water temperature anomaly', 'units':'Kelvin', 'comments': 'Estimated near-surface diurnal sea water temperature anomaly from drifting buoy measurements'}),
+    ragged_variable('err_sst', 'err_sst', 'obs', 'float32', variable='err_sst', decoder=fill_values, attrs={'long_name': 'Standard uncertainty of fitted sea water temperature', 'units':'Kelvin', 'comments': 'Estimated one standard error of near-surface sea water temperature estimate from drifting buoy measurements'}),
+    ragged_variable('err_sst1', 'err_sst1', 'obs', 'float32', variable='err_sst1', decoder=fill_values, attrs={'long_name': 'Standard uncertainty of fitted non-diurnal sea water temperature', 'units':'Kelvin', 'comments': 'Estimated one standard error of near-surface non-diurnal sea water temperature estimate from drifting buoy measurements'}),
+    ragged_variable('err_sst2', 'err_sst2', 'obs', 'float32', variable='err_sst2', decoder=fill_values, attrs={'long_name': 'Standard uncertainty of fitted diurnal sea water temperature anomaly', 'units':'Kelvin', 'comments': 'Estimated one standard error of near-surface diurnal sea water temperature anomaly estimate from drifting buoy measurements'}),
+    ragged_variable('flg_sst', 'flg_sst', 'obs', 'int8', variable='flg_sst', attrs={'long_name': 'Fitted sea water temperature quality flag', 'units':'-', 'flag_values':'0, 1, 2, 3, 4, 5', 'flag_meanings': 'no-estimate, no-uncertainty-estimate, estimate-not-in-range-uncertainty-not-in-range, estimate-not-in-range-uncertainty-in-range estimate-in-range-uncertainty-not-in-range, estimate-in-range-uncertainty-in-range'}),
+    ragged_variable('flg_sst1', 'flg_sst1', 'obs', 'int8', variable='flg_sst1', attrs={'long_name': 'Fitted non-diurnal sea water temperature quality flag', 'units':'-', 'flag_values':'0, 1, 2, 3, 4, 5', 'flag_meanings': 'no-estimate, no-uncertainty-estimate, estimate-not-in-range-uncertainty-not-in-range, estimate-not-in-range-uncertainty-in-range estimate-in-range-uncertainty-not-in-range, estimate-in-range-uncertainty-in-range'}),
+    ragged_variable('flg_sst2', 'flg_sst2', 'obs', 'int8', variable='flg_sst2', attrs={'long_name': 'Fitted diurnal sea water temperature anomaly quality flag', 'units':'-', 'flag_values':'0, 1, 2, 3, 4, 5', 'flag_meanings': 'no-estimate, no-uncertainty-estimate, estimate-not-in-range-uncertainty-not-in-range, estimate-not-in-range-uncertainty-in-range estimate-in-range-uncertainty-not-in-range, estimate-in-range-uncertainty-in-range'}),
+]
+SCHEMA_VARIABLES = {v.name: v for v in SCHEMA}
+
+# global attributes of the ragged array
+GLOBAL_ATTRS = {
+    'title': 'Global Drifter Program hourly drifting buoy collection',
+    'history': 'Version 2.00.  Metadata from dirall.dat and deplog.dat',
+    'Conventions': 'CF-1.6',
+    'date_created': None,  # set by to_xarray
+    'publisher_name': 'GDP Drifter DAC',
+    'publisher_email': 'aoml.dftr@noaa.gov',
+    'publisher_url': 'https://www.aoml.noaa.gov/phod/gdp',
+    'licence': 'MIT License',
+    'processing_level': 'Level 2 QC by GDP drifter DAC',
+    'metadata_link': 'https://www.aoml.noaa.gov/phod/dac/dirall.html',
+    'contributor_name': 'NOAA Global Drifter Program',
+    'contributor_role': 'Data Acquisition Center',
+    'institution': 'NOAA Atlantic Oceanographic and Meteorological Laboratory',
+    'acknowledgement': 'Elipot et al. (2022) to be submitted. Elipot et al. (2016). Global Drifter Program quality-controlled hourly interpolated data from ocean surface drifting buoys, version 2.00. NOAA National Centers for Environmental Information. https://agupubs.onlinelibrary.wiley.com/doi/full/10.1002/2016JC011716TBA. Accessed [date].',
+    'summary': 'Global Drifter Program hourly data',
+}
+
+
+def select_variables(variables=None) -> list:
+    '''
+    Schema entries of a selection of variables (the trajectory 'ID' is always included)
+
+    :param variables: names of the variables (None: all the variables of SCHEMA)
+    :return: list of ragged_variable (in the order of SCHEMA)
+    '''
+    if variables is None:
+        return list(SCHEMA)
+    if isinstance(variables, str):
+        variables = [variables]
+    unknown = set(variables) - set(SCHEMA_VARIABLES)
+    if unknown:
+        raise ValueError(f'Unknown variables {sorted(unknown)}, available variables are {list(SCHEMA_VARIABLES)}')
+    selected = set(variables) | {'ID'}
+    return [v for v in SCHEMA if v.name in selected]
+
+
+def read_trajectory(file, profile=False, variables=None) -> dict:
+    '''
+    Open one trajectory file (once) and read the raw values of the selected variables.
+    This is a module-level function so it can be dispatched to a process pool.
+
+    :param file: path and filename of the netCDF file
+           profile: also return the file name and the time spent reading it (see ingestion_profiler)
+           variables: names of the variables of the ragged array (None: all, see select_variables)
+    :return: dict of raw values by variable name: scalars ('traj'), vectors ('obs') and string
+             attributes, decoded when stored (see create_ragged_array.store_trajectory)
+    '''
+    start = time.perf_counter() if profile else None
+    schema = select_variables(variables)
+    sources = {v.name: v for v in schema}
+    sources.update({name: SCHEMA_VARIABLES[name] for v in schema for name in v.requires})
+
+    with xr.open_dataset(file, decode_times=False) as ds:
+        data = {}
+        for name, v in sources.items():
+            if v.variable is not None:
+                data[name] = ds[v.variable].data[0]
+            elif v.attribute is not None:
+                data[name] = ds.attrs.get(v.attribute, '')
+
+    if profile:
+        data['file'] = file
+        data['read_time'] = time.perf_counter() - start
+
+    return data
+
+
+NO_PROFILE = contextlib.nullcontext()  # shared no-op stage when profiling is disabled
+
+
+def peak_rss(children=False):
+    '''
+    Peak resident memory [bytes] of the process (or of its largest terminated child process),
+    None when not available on the platform
+    '''
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class ingestion_profiler:
+    def __init__(self, callback=None, slowest=10):
+        '''
+        Timers of the stages of the ragged array construction and of each file,
+        pass an instance (or True) as `profile` to create_ragged_array
+
+        :param callback: function called with a dict for every completed stage
+                         ({'event': 'stage', 'stage', 'time'}) and file ({'event': 'file', 'file',
+                         'bytes', 'obs', 'read_time', 'store_time'}), e.g. to feed a monitoring system
+               slowest: number of slowest files listed in the report
+        '''
+        self.callback = callback
+        self.slowest = slowest
+        self.stages = {}
+        self.files = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Accumulate the time spent in the `with` block in the stage `name`
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+            if self.callback is not None:
+                self.callback({'event': 'stage', 'stage': name, 'time': elapsed})
+
+    def add_file(self, file, obs, read_time, store_time):
+        '''
+        Record one decoded file: read_time is spent opening and reading the file (possibly
+        in a worker process), store_time decoding and copying it in the ragged array
+        '''
+        record = {
+            'file': file, 'bytes': os.path.getsize(file), 'obs': int(obs),
+            'read_time': read_time, 'store_time': store_time,
+        }
+        self.files.append(record)
+        if self.callback is not None:
+            self.callback(dict(record, event='file'))
+
+    def report(self) -> dict:
+        '''
+        Summary of the profiling (JSON-serializable)
+
+        :return: dict with the time per stage, the number of files, bytes and observations read,
+                 the throughput of the ingestion, the peak RSS and the slowest files
+        '''
+        nb_bytes = sum(f['bytes'] for f in self.files)
+        nb_obs = sum(f['obs'] for f in self.files)
+        ingest = self.stages.get('ingest', 0.0)
+        return {
+            'stages': dict(self.stages),
+            'files': len(self.files),
+            'bytes': nb_bytes,
+            'obs': nb_obs,
+            'read_time': sum(f['read_time'] for f in self.files),
+            'store_time': sum(f['store_time'] for f in self.files),
+            'obs_per_second': nb_obs / ingest if ingest else None,
+            'bytes_per_second': nb_bytes / ingest if ingest else None,
+            'peak_rss': peak_rss(),
+            'peak_rss_children': peak_rss(children=True),
+            'slowest_files': sorted(self.files, key=lambda f: f['read_time'] + f['store_time'], reverse=True)[:self.slowest],
+        }
+
+    def to_json(self, filename=None):
+        '''
+        Report as a JSON string, also written to filename if set
+        '''
+        report = json.dumps(self.report(), indent=1)
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(report)
+        return report
+
+
+def profiled(name):
+    '''
+    Time a method of create_ragged_array as the stage `name` when profiling is enabled
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.profile is None:
+                return method(self, *args, **kwargs)
+            with self.profile.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class create_ragged_array:
-    def __init__(self, files):
+    def __init__(self, files, workers=None, path=None, batch_size=1000, profile=None, variables=None):
+        '''
+        Build the ragged array from a list of trajectory files
+
+        :param files: list of netCDF files (one trajectory per file)
+               workers: number of processes used to decode the files (None: all cores, 1: serial)
+               path: if set, folder where the observations are streamed as `.npy` columns
+                     instead of being kept in memory (see stream_ragged_array)
+               batch_size: number of trajectories buffered in memory before writing to path
+               profile: True or an ingestion_profiler to time the stages and the files (see self.profile.report())
+               variables: names of the variables of the ragged array (None: all, see SCHEMA); the
+                          other variables are neither read from the files nor allocated
+        '''
+        self.profile = ingestion_profiler() if profile is True else (profile or None)
         self.files = files
+        self.schema = select_variables(variables)
+        self.variables = [v.name for v in self.schema]
+        self.traj_schema = [v for v in self.schema if v.dim == 'traj']
+        self.obs_schema = [v for v in self.schema if v.dim == 'obs']
         self.rowsize = self.number_of_observations(self.files)
         self.nb_traj = len(self.rowsize)
         self.nb_obs = np.sum(self.rowsize).astype('int')
-        self.allocate_data(self.nb_traj, self.nb_obs)
         self.index_traj = np.insert(np.cumsum(self.rowsize), 0, 0)
 
-        for i, file in tqdm(enumerate(self.files), total=len(self.files)):
-            #print(f'{i+1}/{self.nb_traj} files processed', end='\r')
-            self.fill_ragged_array(file, i, self.index_traj[i])
+        if path is None:
+            self.allocate_data(self.nb_traj, self.nb_obs)
+
+            # each file is decoded once (possibly in another process) and its
+            # columns are copied at their offset in the preallocated arrays
+            with self.stage('ingest'):
+                for i, data in tqdm(enumerate(self.read_trajectories(self.files, workers, self.profile is not None, self.variables)), total=len(self.files)):
+                    self.store_trajectory(data, i, self.index_traj[i])
+        else:
+            self.stream_ragged_array(path, workers, batch_size)
+
+        self.parse_metadata()
+
+    def stream_ragged_array(self, path, workers=None, batch_size=1000):
+        '''
+        Out-of-core version of the ragged array construction. The observations of
+        `batch_size` trajectories are gathered in memory and then written at their
+        offset in preallocated `.npy` files. Once completed, the observation variables
+        are memory-mapped (read-only) from those files.
+
+        At most `batch_size` files are decoded ahead of the current trajectory, so the memory
+        is bounded by about two batches whatever the number of workers.
+        Note: to_xarray() converts `time` to datetime64[ns] in memory (xarray only supports
+        nanosecond precision); use self.time to keep working on the memory-mapped column.
+
+        :param path: output folder of the `.npy` columns
+               workers: number of processes used to decode the files
+               batch_size: number of trajectories per batch
+        '''
+        os.makedirs(path, exist_ok=True)
+        self.allocate_metadata(self.nb_traj)
+
+        # preallocate the columns on disk (sparse files, nothing is held in memory)
+        self.allocate_observations(0)
+        columns = {v.attr: os.path.join(path, f'{v.attr}.npy') for v in self.obs_schema}
+        for var, filename in columns.items():
+            column = np.lib.format.open_memmap(filename, mode='w+', dtype=getattr(self, var).dtype, shape=(self.nb_obs,))
+            del column
+
+        def flush(first, last):
+            start, end = self.index_traj[first], self.index_traj[last]
+            with self.stage('flush'):
+                for var, filename in columns.items():
+                    column = np.lib.format.open_memmap(filename, mode='r+')
+                    column[start:end] = getattr(self, var)
+                    column.flush()
+                    del column
 
+        first = 0
+        with self.stage('ingest'):
+            for i, data in tqdm(enumerate(self.read_trajectories(self.files, workers, self.profile is not None, self.variables, prefetch=batch_size)), total=len(self.files)):
+                if i == first:
+                    last = min(first + batch_size, self.nb_traj)
+                    self.allocate_observations(self.index_traj[last] - self.index_traj[first])
+                self.store_trajectory(data, i, self.index_traj[i] - self.index_traj[first])
+                if i + 1 == last:
+                    flush(first, last)
+                    first = last
+
+        for var, filename in columns.items():
+            setattr(self, var, np.asarray(np.load(filename, mmap_mode='r')))  # ndarray view of the memmap
+
+    @staticmethod
+    def read_trajectories(files, workers=None, profile=False, variables=None, prefetch=None):
+        '''
+        Decode the trajectory files, in parallel if workers != 1
+
+        :param prefetch: maximum number of files submitted to the workers ahead of the trajectory
+                         being consumed (None: all the files are submitted at once)
+        :return: iterator over the decoded trajectories (same order as files)
+        '''
+        read = functools.partial(read_trajectory, profile=profile, variables=variables)
+        if workers == 1:
+            yield from map(read, files)
+            return
+
+        nb_workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=nb_workers) as executor:
+            if prefetch is None:
+                chunksize = max(1, len(files) // (4 * nb_workers))
+                yield from executor.map(read, files, chunksize=chunksize)
+                return
+
+            # bounded window: a new file is submitted each time a result is consumed
+            files = iter(files)
+            pending = deque(executor.submit(read, file) for file in itertools.islice(files, max(prefetch, 1)))
+            while pending:
+                data = pending.popleft().result()
+                pending.extend(executor.submit(read, file) for file in itertools.islice(files, 1))
+                yield data
+
+    def stage(self, name):
+        '''
+        Context timing the stage `name` (no-op when profiling is disabled)
+        '''
+        return NO_PROFILE if self.profile is None else self.profile.stage(name)
+
+    @profiled('scan')
     def number_of_observations(self, files) -> np.array:
         '''
-        Load files and get the size of the observations.
+        Get the size of the observations from the header of each file (no variable is read).
         '''
         rowsize = np.zeros(len(files), dtype='int')
         for i, file in enumerate(files):
-            with xr.open_dataset(file, decode_times=False) as ds:
-                rowsize[i] = ds.sizes['obs']
+            with nc.Dataset(file) as f:
+                rowsize[i] = f.dimensions['obs'].size
         return rowsize
 
+    @profiled('allocate')
     def allocate_data(self, nb_traj, nb_obs):
         '''
         Reserve the space for the total size of the array
         '''
-        # metadata
-        self.id = np.zeros(nb_traj, dtype='int64')
-        self.location_type = np.zeros(nb_traj, dtype='bool') # 0 Argos, 1 GPS
-        self.wmo = np.zeros(nb_traj, dtype='int32')
-        self.expno = np.zeros(nb_traj, dtype='int32')
-        self.deploy_date = np.zeros(nb_traj, dtype='datetime64[s]')
-        self.deploy_lat = np.zeros(nb_traj, dtype='float32')
-        self.deploy_lon = np.zeros(nb_traj, dtype='float32')
-        self.end_date = np.zeros(nb_traj, dtype='datetime64[s]')
-        self.end_lon = np.zeros(nb_traj, dtype='float32')
-        self.end_lat = np.zeros(nb_traj, dtype='float32')
-        self.drogue_lost_date = np.zeros(nb_traj, dtype='datetime64[s]')
-        self.type_death = np.zeros(nb_traj, dtype='int8')
-        self.type_buoy = np.chararray(nb_traj, itemsize=15)
-        self.deployment_ship = np.chararray(nb_traj, itemsize=15)
-        self.deployment_status = np.chararray(nb_traj, itemsize=15)
-        self.buoy_type_manufacturer = np.chararray(nb_traj, itemsize=15)
-        self.buoy_type_sensor_array = np.chararray(nb_traj, itemsize=15)
-        self.current_program = np.zeros(nb_traj, dtype='int32')
-        self.purchaser_funding = np.chararray(nb_traj, itemsize=15)
-        self.sensor_upgrade = np.chararray(nb_traj, itemsize=15)
-        self.transmissions = np.chararray(nb_traj, itemsize=15)
-        self.deploying_country = np.chararray(nb_traj, itemsize=15)
-        self.deployment_comments = np.chararray(nb_traj, itemsize=15)
-        self.manufacture_year = np.zeros(nb_traj, dtype='int16')
-        self.manufacture_month = np.zeros(nb_traj, dtype='int16')
-        self.manufacture_sensor_type = np.chararray(nb_traj, itemsize=5)
-        self.manufacture_voltage = np.zeros(nb_traj, dtype='int16')
-        self.float_diameter = np.zeros(nb_traj, dtype='float32')
-        self.subsfc_float_presence = np.zeros(nb_traj, dtype='bool')
-        self.drogue_type = np.chararray(nb_traj, itemsize=15)
-        self.drogue_length = np.zeros(nb_traj, dtype='float32')
-        self.drogue_ballast = np.zeros(nb_traj, dtype='float32')
-        self.drag_area_above_drogue = np.zeros(nb_traj, dtype='float32')
-        self.drag_area_drogue = np.zeros(nb_traj, dtype='float32')
-        self.drag_area_ratio = np.zeros(nb_traj, dtype='float32')
-        self.drag_center_depth = np.zeros(nb_traj, dtype='float32')
-        self.drogue_detect_sensor = np.chararray(nb_traj, itemsize=15)
-
-        # values define at every observations (timesteps)
-        self.lon = np.zeros(nb_obs, dtype='float32')
-        self.lat = np.zeros(nb_obs, dtype='float32')
-        self.time = np.zeros(nb_obs, dtype='datetime64[s]')
-        self.ve = np.zeros(nb_obs, dtype='float32')
-        self.vn = np.zeros(nb_obs, dtype='float32')
-        self.err_lat = np.zeros(nb_obs, dtype='float32')
-        self.err_lon = np.zeros(nb_obs, dtype='float32')
-        self.err_ve = np.zeros(nb_obs, dtype='float32')
-        self.err_vn = np.zeros(nb_obs, dtype='float32')
-        self.gap = np.zeros(nb_obs, dtype='float32')
-        self.drogue_status = np.zeros(nb_obs, dtype='bool') # 1 drogued, 0 undrogued
-
-        # sst data set
-        self.sst = np.zeros(nb_obs, dtype='float32')
-        self.sst1 = np.zeros(nb_obs, dtype='float32')
-        self.sst2 = np.zeros(nb_obs, dtype='float32')
-        self.err_sst = np.zeros(nb_obs, dtype='float32')
-        self.err_sst1 = np.zeros(nb_obs, dtype='float32')
-        self.err_sst2 = np.zeros(nb_obs, dtype='float32')
-        self.flg_sst = np.zeros(nb_obs, dtype='int8')
-        self.flg_sst1 = np.zeros(nb_obs, dtype='int8')
-        self.flg_sst2 = np.zeros(nb_obs, dtype='int8')
+        self.allocate_metadata(nb_traj)
+        self.allocate_observations(nb_obs)
+
+    def allocate_metadata(self, nb_traj):
+        '''
+        Reserve the space for the raw values of the variables defined per trajectory,
+        decoded to their columns by parse_metadata()
+        '''
+        self.raw = {v.name: np.empty(nb_traj, dtype='object') for v in self.traj_schema}
+        self.category_attrs = {}
+
+    def allocate_observations(self, nb_obs):
+        '''
+        Reserve the space for the variables defined at every observations (timesteps)
+        '''
+        for v in self.obs_schema:
+            setattr(self, v.attr, np.zeros(nb_obs, dtype=v.dtype))
 
     def fill_ragged_array(self, file, tid, oid):
         '''
@@ -172,335 +663,941 @@ class create_ragged_array:
               tid: trajectory index
               oid: observation index in the ragged array
         '''
-        ds = xr.open_dataset(file, decode_times=False)
-        size = ds.dims['obs']
-
-        # scalar
-        self.id[tid] = int(ds.ID.data[0])
-        self.wmo[tid] = ds.WMO.data[0]
-        self.expno[tid] = ds.expno.data[0]
-        self.deploy_date[tid] = decode_date(ds.deploy_date.data[0])
-        self.deploy_lon[tid] = ds.deploy_lon.data[0]
-        self.deploy_lat[tid] = ds.deploy_lat.data[0]
-        self.end_date[tid] = decode_date(ds.end_date.data[0])
-        self.end_lon[tid] = ds.end_lon.data[0]
-        self.end_lat[tid] = ds.end_lat.data[0]
-        self.drogue_lost_date[tid] = decode_date(ds.drogue_lost_date.data[0])
-        self.type_death[tid] = ds.typedeath.data[0]
-        self.type_buoy[tid] = ds.typebuoy.data[0]
-
-        # vectors
-        self.lon[oid:oid+size] = ds.longitude.data[0]
-        self.lat[oid:oid+size] = ds.latitude.data[0]
-        self.time[oid:oid+size] = decode_date(ds.time.data[0])
-        self.ve[oid:oid+size] = ds.ve.data[0]
-        self.vn[oid:oid+size] = ds.vn.data[0]
-        self.err_lat[oid:oid+size] = ds.err_lat.data[0]
-        self.err_lon[oid:oid+size] = ds.err_lon.data[0]
-        self.err_ve[oid:oid+size] = ds.err_ve.data[0]
-        self.err_vn[oid:oid+size] = ds.err_vn.data[0]
-        self.gap[oid:oid+size] = ds.gap.data[0]
-        self.sst[oid:oid+size] = fill_values(ds.sst.data[0])
-        self.sst1[oid:oid+size] = fill_values(ds.sst1.data[0])
-        self.sst2[oid:oid+size] = fill_values(ds.sst2.data[0])
-        self.err_sst[oid:oid+size] = fill_values(ds.err_sst.data[0])
-        self.err_sst1[oid:oid+size] = fill_values(ds.err_sst1.data[0])
-        self.err_sst2[oid:oid+size] = fill_values(ds.err_sst2.data[0])
-        self.flg_sst[oid:oid+size] = ds.flg_sst.data[0]
-        self.flg_sst1[oid:oid+size] = ds.flg_sst1.data[0]
-        self.flg_sst2[oid:oid+size] = ds.flg_sst2.data[0]
-        self.drogue_status[oid:oid+size] = drogue_presence(self.drogue_lost_date[tid], self.time[oid:oid+size])
-
-        # those values were store in the attributes
-        self.location_type[tid] = 0 if ds.location_type == 'Argos' else 1  # 0 Argos, 1 GPS
-        self.deployment_ship[tid] = cut_str(ds.DeployingShip, 15)
-        self.deployment_status[tid] = cut_str(ds.DeploymentStatus, 15)
-        self.buoy_type_manufacturer[tid] = cut_str(ds.BuoyTypeManufacturer, 15)
-        self.buoy_type_sensor_array[tid] = cut_str(ds.BuoyTypeSensorArray, 15)
-        self.current_program[tid] = str_to_float(ds.CurrentProgram, -1)
-        self.purchaser_funding[tid] = cut_str(ds.PurchaserFunding, 15)
-        self.sensor_upgrade[tid] = cut_str(ds.SensorUpgrade, 15)
-        self.transmissions[tid] = cut_str(ds.Transmissions, 15)
-        self.deploying_country[tid] = cut_str(ds.DeployingCountry, 15)
-        self.deployment_comments[tid] = cut_str(ds.DeploymentComments.encode('ascii', 'ignore').decode('ascii'), 15) # remove not ascii char
-        self.manufacture_year[tid] = str_to_float(ds.ManufactureYear, -1)
-        self.manufacture_month[tid] = str_to_float(ds.ManufactureMonth, -1)
-        self.manufacture_sensor_type[tid] = cut_str(ds.ManufactureSensorType, 15)
-        self.manufacture_voltage[tid] = str_to_float(ds.ManufactureVoltage[:-6], -1) # e.g. 56 V
-        self.float_diameter[tid] = str_to_float(ds.FloatDiameter[:-3]) # e.g. 35.5 cm
-        self.subsfc_float_presence[tid] = str_to_float(ds.SubsfcFloatPresence)
-        self.drogue_type[tid] = cut_str(ds.DrogueType, 7)
-        self.drogue_length[tid] = str_to_float(ds.DrogueLength[:-2]) # e.g. 4.8 m
-        self.drogue_ballast[tid] = str_to_float(ds.DrogueBallast[:-3]) # e.g. 1.4 kg
-        self.drag_area_above_drogue[tid] = str_to_float(ds.DragAreaAboveDrogue[:-4]) # 10.66 m^2
-        self.drag_area_drogue[tid] = str_to_float(ds.DragAreaOfDrogue[:-4]) # e.g. 416.6 m^2
-        self.drag_area_ratio[tid] = str_to_float(ds.DragAreaRatio) # e.g. 39.08
-        self.drag_center_depth[tid] = str_to_float(ds.DrogueCenterDepth[:-2]) # e.g. 15.0 m
-        self.drogue_detect_sensor[tid] = cut_str(ds.DrogueDetectSensor, 15)
+        self.store_trajectory(read_trajectory(file, self.profile is not None, self.variables), tid, oid)
 
+    def store_trajectory(self, data, tid, oid):
+        '''
+        Copy one decoded trajectory (see read_trajectory) into the ragged array
+
+        Input data: dict of decoded values
+              tid: trajectory index
+              oid: observation index in the ragged array
+        '''
+        start = time.perf_counter() if self.profile is not None else None
+        size = self.rowsize[tid]
+
+        for v in self.traj_schema:
+            self.raw[v.name][tid] = data[v.name]
+
+        for v in self.obs_schema:
+            out = getattr(self, v.attr)[oid:oid+size]
+            if v.requires:
+                out[:] = v.decoder(data)
+            elif v.decoder is not None:
+                v.decoder(data[v.name], out=out)
+            else:
+                out[:] = data[v.name]
+
+        if self.profile is not None and 'read_time' in data:
+            self.profile.add_file(data['file'], size, data['read_time'], time.perf_counter() - start)
+
+    @profiled('parse_metadata')
+    def parse_metadata(self):
+        '''
+        Decode the raw values of all the trajectories to the metadata variables (see SCHEMA).
+        The strings are dictionary encoded (see categorical) and the attributes describing their
+        categories (see categorical_attrs) kept in self.category_attrs.
+        Each attribute is parsed once for all trajectories and a summary of the missing and
+        unparsable values is stored in self.metadata_report.
+        '''
+        self.metadata_report = {}
+        for v in self.traj_schema:
+            values = self.raw[v.name]
+            if v.variable is not None:
+                values = np.array(values.tolist())  # typed as in the files
+            column = values if v.decoder is None else v.decoder(values)
+            if isinstance(column, tuple):
+                column, info = column
+                if isinstance(info, dict):
+                    self.metadata_report[v.attribute] = info
+                else:
+                    self.category_attrs[v.attr] = categorical_attrs(info)
+            setattr(self, v.attr, column if v.dtype is None else np.asarray(column).astype(v.dtype))
+        del self.raw
+
+        failed = {name: r['failed_values'] for name, r in self.metadata_report.items() if r['failed']}
+        if failed:
+            warnings.warn(f'Some metadata attributes could not be parsed and were set to their default value: {failed}')
+        unexpected = {name: r['unexpected_values'] for name, r in self.metadata_report.items() if r['unexpected_units']}
+        if unexpected:
+            warnings.warn(f'Some metadata attributes have an unexpected unit and were set to their default value: {unexpected}')
+
+    @profiled('to_xarray')
     def to_xarray(self):
-        ds = xr.Dataset(
-            data_vars=dict(
-                rowsize=(['traj'], self.rowsize, {'long_name': 'Number of observations per trajectory', 'sample_dimension': 'obs', 'units':'-'}),
-                location_type=(['traj'], self.location_type, {'long_name': 'Satellite-based location system', 'units':'-', 'comments':'0 (Argos), 1 (GPS)'}),
-                WMO=(['traj'], self.wmo, {'long_name': 'World Meteorological Organization buoy identification number', 'units':'-'}),
-                expno=(['traj'], self.expno, {'long_name': 'Experiment number', 'units':'-'}),
-                deploy_date=(['traj'], self.deploy_date, {'long_name': 'Deployment date and time'}),
-                deploy_lon=(['traj'], self.deploy_lon, {'long_name': 'Deployment longitude', 'units':'degrees_east'}),
-                deploy_lat=(['traj'], self.deploy_lat, {'long_name': 'Deployment latitude', 'units':'degrees_north'}),
-                end_date=(['traj'], self.end_date, {'long_name': 'End date and time'}),
-                end_lat=(['traj'], self.end_lat, {'long_name': 'End latitude', 'units':'degrees_north'}),
-                end_lon=(['traj'], self.end_lon, {'long_name': 'End longitude', 'units':'degrees_east'}),
-                drogue_lost_date=(['traj'], self.drogue_lost_date, {'long_name': 'Date and time of drogue loss'}),
-                type_death=(['traj'], self.type_death, {'long_name': 'Type of death', 'units':'-', 'comments': '0 (buoy still alive), 1 (buoy ran aground), 2 (picked up by vessel), 3 (stop transmitting), 4 (sporadic transmissions), 5 (bad batteries), 6 (inactive status)'}),
-                type_buoy=(['traj'], self.type_buoy, {'long_name': 'Buoy type (see https://www.aoml.noaa.gov/phod/dac/dirall.html)', 'units':'-'}),
-                DeploymentShip=(['traj'], self.deployment_ship, {'long_name': 'Name of deployment ship', 'units':'-'}),
-                DeploymentStatus=(['traj'], self.deployment_status, {'long_name': 'Deployment status', 'units':'-'}),
-                BuoyTypeManufacturer=(['traj'], self.buoy_type_manufacturer, {'long_name': 'Buoy type manufacturer', 'units':'-'}),
-                BuoyTypeSensorArray=(['traj'], self.buoy_type_sensor_array, {'long_name': 'Buoy type sensor array', 'units':'-'}),
-                CurrentProgram=(['traj'], self.current_program, {'long_name': 'Current Program', 'units':'-', '_FillValue': '-1'}),
-                PurchaserFunding=(['traj'], self.purchaser_funding, {'long_name': 'Purchaser funding', 'units':'-'}),
-                SensorUpgrade=(['traj'], self.sensor_upgrade, {'long_name': 'Sensor upgrade', 'units':'-'}),
-                Transmissions=(['traj'], self.transmissions, {'long_name': 'Transmissions', 'units':'-'}),
-                DeployingCountry=(['traj'], self.deploying_country, {'long_name': 'Deploying country', 'units':'-'}),
-                DeploymentComments=(['traj'], self.deployment_comments, {'long_name': 'Deployment comments', 'units':'-'}),
-                ManufactureYear=(['traj'], self.manufacture_year, {'long_name': 'Manufacture year', 'units':'-', '_FillValue': '-1'}),
-                ManufactureMonth=(['traj'], self.manufacture_month, {'long_name': 'Manufacture month', 'units':'-', '_FillValue': '-1'}),
-                ManufactureSensorType=(['traj'], self.manufacture_sensor_type, {'long_name': 'Manufacture Sensor Type', 'units':'-'}),
-                ManufactureVoltage=(['traj'], self.manufacture_voltage, {'long_name': 'Manufacture voltage', 'units':'-', '_FillValue': '-1'}),
-                FloatDiameter=(['traj'], self.float_diameter, {'long_name': 'Diameter of surface floater', 'units':'cm'}),
-                SubsfcFloatPresence=(['traj'], self.subsfc_float_presence, {'long_name': 'Subsurface Float Presence', 'units':'-'}),
-                DrogueType=(['traj'], self.type_buoy, {'drogue_type': 'Drogue Type', 'units':'-'}),
-                DrogueLength=(['traj'], self.drogue_length, {'long_name': 'Length of drogue.', 'units':'m'}),
-                DrogueBallast=(['traj'], self.drogue_ballast, {'long_name': "Weight of the drogue's ballast.", 'units':'kg'}),
-                DragAreaAboveDrogue=(['traj'], self.drag_area_above_drogue, {'long_name': 'Drag area above drogue.', 'units':'m^2'}),
-                DragAreaOfDrogue=(['traj'], self.drag_area_drogue, {'long_name': 'Drag area drogue.', 'units':'m^2'}),
-                DragAreaRatio=(['traj'], self.drag_area_ratio, {'long_name': 'Drag area ratio', 'units':'m'}),
-                DrogueCenterDepth=(['traj'], self.drag_center_depth, {'long_name': 'Average depth of the drogue.', 'units':'m'}),
-                DrogueDetectSensor=(['traj'], self.drogue_detect_sensor, {'long_name': 'Drogue detection sensor', 'units':'-'}),
-
-                # position and velocity
-                ve=(['obs'], self.ve, {'long_name': 'Eastward velocity', 'units':'m/s'}),
-                vn=(['obs'], self.vn, {'long_name': 'Northward velocity', 'units':'m/s'}),
-                gap=(['obs'], self.gap, {'long_name': 'Time interval between previous and next location', 'units':'s'}),
-                err_lat=(['obs'], self.err_lat, {'long_name': '95% confidence interval in latitude', 'units':'degrees_north'}),
-                err_lon=(['obs'], self.err_lon, {'long_name': '95% confidence interval in longitude', 'units':'degrees_east'}),
-                err_ve=(['obs'], self.err_ve, {'long_name': '95% confidence interval in eastward velocity', 'units':'m/s'}),
-                err_vn=(['obs'], self.err_vn, {'long_name': '95% confidence interval in northward velocity', 'units':'m/s'}),
-                drogue_status=(['obs'], self.drogue_status, {'long_name': 'Status indicating the presence of the drogue', 'units':'-', 'flag_values':'1,0', 'flag_meanings': 'drogued, undrogued'}),
-
-                # sst
-                sst=(['obs'], self.sst, {'long_name': 'Fitted sea water temperature', 'units':'Kelvin', 'comments': 'Estimated near-surface sea water temperature from drifting buoy measurements. It is the sum of the fitted near-surface non-diurnal sea water temperature and fitted diurnal sea water temperature anomaly. Discrepancies may occur because of rounding.'}),
-                sst1=(['obs'], self.sst1, {'long_name': 'Fitted non-diurnal sea water temperature', 'units':'Kelvin', 'comments': 'Estimated near-surface non-diurnal sea water temperature from drifting buoy measurements'}),
-                sst2=(['obs'], self.sst2, {'long_name': 'Fitted diurnal sea water temperature anomaly', 'units':'Kelvin', 'comments': 'Estimated near-surface diurnal sea water temperature anomaly from drifting buoy measurements'}),
-                err_sst=(['obs'], self.err_sst, {'long_name': 'Standard uncertainty of fitted sea water temperature', 'units':'Kelvin', 'comments': 'Estimated one standard error of near-surface sea water temperature estimate from drifting buoy measurements'}),
-                err_sst1=(['obs'], self.err_sst1, {'long_name': 'Standard uncertainty of fitted non-diurnal sea water temperature', 'units':'Kelvin', 'comments': 'Estimated one standard error of near-surface non-diurnal sea water temperature estimate from drifting buoy measurements'}),
-                err_sst2=(['obs'], self.err_sst2, {'long_name': 'Standard uncertainty of fitted diurnal sea water temperature anomaly', 'units':'Kelvin', 'comments': 'Estimated one standard error of near-surface diurnal sea water temperature anomaly estimate from drifting buoy measurements'}),
-                flg_sst=(['obs'], self.flg_sst, {'long_name': 'Fitted sea water temperature quality flag', 'units':'-', 'flag_values':'0, 1, 2, 3, 4, 5', 'flag_meanings': 'no-estimate, no-uncertainty-estimate, estimate-not-in-range-uncertainty-not-in-range, estimate-not-in-range-uncertainty-in-range estimate-in-range-uncertainty-not-in-range, estimate-in-range-uncertainty-in-range'}),
-                flg_sst1=(['obs'], self.flg_sst1, {'long_name': 'Fitted non-diurnal sea water temperature quality flag', 'units':'-', 'flag_values':'0, 1, 2, 3, 4, 5', 'flag_meanings': 'no-estimate, no-uncertainty-estimate, estimate-not-in-range-uncertainty-not-in-range, estimate-not-in-range-uncertainty-in-range estimate-in-range-uncertainty-not-in-range, estimate-in-range-uncertainty-in-range'}),
-                flg_sst2=(['obs'], self.flg_sst2, {'long_name': 'Fitted diurnal sea water temperature anomaly quality flag', 'units':'-', 'flag_values':'0, 1, 2, 3, 4, 5', 'flag_meanings': 'no-estimate, no-uncertainty-estimate, estimate-not-in-range-uncertainty-not-in-range, estimate-not-in-range-uncertainty-in-range estimate-in-range-uncertainty-not-in-range, estimate-in-range-uncertainty-in-range'}),
-             ),
-
-            coords=dict(
-                ID=(['traj'], self.id, {'long_name': 'Global Drifter Program Buoy ID', 'units':'-'}),
-                lon=(['obs'], self.lon, {'long_name': 'Longitude', 'units':'degrees_east'}),
-                lat=(['obs'], self.lat, {'long_name': 'Latitude', 'units':'degrees_north'}),
-                time=(['obs'], self.time, {'long_name': 'Time'}),
-                ids=(['obs'], np.repeat(self.id, self.rowsize), {'long_name': "Global Drifter Program Buoy identification number repeated along observations", 'units':'-'}),
-            ),
-
-            attrs={
-                'title': 'Global Drifter Program hourly drifting buoy collection',
-                'history': 'Version 2.00.  Metadata from dirall.dat and deplog.dat',
-                'Conventions': 'CF-1.6',
-                'date_created': datetime.now().isoformat(),
-                'publisher_name': 'GDP Drifter DAC',
-                'publisher_email': 'aoml.dftr@noaa.gov',
-                'publisher_url': 'https://www.aoml.noaa.gov/phod/gdp',
-                'licence': 'MIT License',
-                'processing_level': 'Level 2 QC by GDP drifter DAC',
-                'metadata_link': 'https://www.aoml.noaa.gov/phod/dac/dirall.html',
-                'contributor_name': 'NOAA Global Drifter Program',
-                'contributor_role': 'Data Acquisition Center',
-                'institution': 'NOAA Atlantic Oceanographic and Meteorological Laboratory',
-                'acknowledgement': 'Elipot et al. (2022) to be submitted. Elipot et al. (2016). Global Drifter Program quality-controlled hourly interpolated data from ocean surface drifting buoys, version 2.00. NOAA National Centers for Environmental Information. https://agupubs.onlinelibrary.wiley.com/doi/full/10.1002/2016JC011716TBA. Accessed [date].',
-                'summary': 'Global Drifter Program hourly data'
-            }
+        '''
+        Ragged array as an xr.Dataset. The datetime64[s] columns are converted to datetime64[ns]
+        by xarray, i.e. copied in memory even when streamed to `.npy` files (see stream_ragged_array).
+        '''
+        data_vars = dict(
+            rowsize=(['traj'], self.rowsize, {'long_name': 'Number of observations per trajectory', 'sample_dimension': 'obs', 'units':'-'}),
+            offset=(['traj'], self.index_traj[:-1].astype('int64'), OFFSET_ATTRS),
+            id_order=(['traj'], np.argsort(self.id, kind='stable'), ID_ORDER_ATTRS),
         )
+        coords = {}
+        for v in self.schema:
+            attrs = dict(v.attrs, **self.category_attrs.get(v.attr, {}))
+            (coords if v.coord else data_vars)[v.name] = ([v.dim], getattr(self, v.attr), attrs)
+
+        ds = xr.Dataset(data_vars=data_vars, coords=coords, attrs=dict(GLOBAL_ATTRS, date_created=datetime.now().isoformat()))
 
-        ds.deploy_date.encoding['units'] = 'seconds since 1970-01-01 00:00:00'
-        ds.end_date.encoding['units'] = 'seconds since 1970-01-01 00:00:00'
-        ds.drogue_lost_date.encoding['units'] = 'seconds since 1970-01-01 00:00:00'
-        ds.time.encoding['units'] = 'seconds since 1970-01-01 00:00:00'
+        for v in self.schema:
+            if v.dtype == 'datetime64[s]':
+                ds[v.name].encoding['units'] = 'seconds since 1970-01-01 00:00:00'
 
         return ds
 
+    def manifest(self, checksum=False) -> list:
+        '''
+        Per-file record of the ragged array, used by update_ragged_array() to detect
+        the files that were added, modified or removed.
 
-def create_ak(ds: xr.Dataset) -> ak.Array:
-    # pointer to the start of each trajectory
-    offset = ak.layout.Index32(np.insert(np.cumsum(ds.rowsize), 0, 0))
-    lon = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.lon), parameters={'attrs': ds.lon.attrs})
-    lat = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.lat), parameters={'attrs': ds.lat.attrs})
-    time = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.time.values), parameters={'attrs': ds.time.attrs})
-    ids = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.ids), parameters={'attrs': ds.ids.attrs})
-    ve = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.ve), parameters={'attrs': ds.ve.attrs})
-    vn = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.vn), parameters={'attrs': ds.vn.attrs})
-    gap = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.gap), parameters={'attrs': ds.gap.attrs})
-    err_lat = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.err_lat), parameters={'attrs': ds.err_lat.attrs})
-    err_lon = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.err_lon), parameters={'attrs': ds.err_lon.attrs})
-    err_ve = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.err_ve), parameters={'attrs': ds.err_ve.attrs})
-    err_vn = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.err_vn), parameters={'attrs': ds.err_vn.attrs})
-    drogue_status = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.drogue_status), parameters={'attrs': ds.drogue_status.attrs})
-    sst = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.sst), parameters={'attrs': ds.sst.attrs})
-    sst1 = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.sst1), parameters={'attrs': ds.sst1.attrs})
-    sst2 = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.sst2), parameters={'attrs': ds.sst2.attrs})
-    err_sst = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.err_sst), parameters={'attrs': ds.err_sst.attrs})
-    err_sst1 = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.err_sst1), parameters={'attrs': ds.err_sst1.attrs})
-    err_sst2 = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.err_sst2), parameters={'attrs': ds.err_sst2.attrs})
-    flg_sst = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.flg_sst), parameters={'attrs': ds.flg_sst.attrs})
-    flg_sst1 = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.flg_sst1), parameters={'attrs': ds.flg_sst1.attrs})
-    flg_sst2 = ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(ds.flg_sst2), parameters={'attrs': ds.flg_sst2.attrs})
-
-    obs = ak.Array(
-        ak.layout.RecordArray(
-            [
-                lon,
-                lat,
-                time,
-                ids,
-                ve,
-                vn,
-                gap,
-                err_lat,
-                err_lon,
-                err_ve,
-                err_vn,
-                drogue_status,
-                sst,
-                sst1,
-                sst2,
-                err_sst,
-                err_sst1,
-                err_sst2,
-                flg_sst,
-                flg_sst1,
-                flg_sst2,
-            ],
-            [
-                'lon',
-                'lat',
-                'time',
-                'ids',
-                've',
-                'vn',
-                'gap',
-                'err_lat',
-                'err_lon',
-                'err_ve',
-                'err_vn',
-                'drogue_status',
-                'sst',
-                'sst1',
-                'sst2',
-                'err_sst',
-                'err_sst1',
-                'err_sst2',
-                'flg_sst',
-                'flg_sst1',
-                'flg_sst2',
-            ],
+        :param checksum: include the sha256 of each file (slower, but robust to touched files)
+        :return: list (one dict per trajectory) of file, mtime, size, [sha256], ID, rowsize, offset
+        '''
+        return [
+            dict(file_signature(file, checksum), ID=int(self.id[i]), rowsize=int(self.rowsize[i]), offset=int(self.index_traj[i]))
+            for i, file in enumerate(self.files)
+        ]
+
+    def to_index(self, cell_size=1.0) -> xr.Dataset:
+        '''
+        Spatio-temporal index of the ragged array (see create_index)
+        '''
+        return index_ragged_array(self.lon, self.lat, self.time, self.rowsize, cell_size)
+
+
+def file_signature(file, checksum=False) -> dict:
+    '''
+    Identify the version of a file by its modification time and size (and optionally its sha256)
+    '''
+    stat = os.stat(file)
+    signature = {'file': os.path.abspath(file), 'mtime': stat.st_mtime, 'size': stat.st_size}
+    if checksum:
+        h = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        signature['sha256'] = h.hexdigest()
+    return signature
+
+
+def write_manifest(manifest, filename):
+    '''
+    Save the manifest of a ragged array (see create_ragged_array.manifest) in a json file
+    '''
+    with open(filename, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def read_manifest(filename) -> list:
+    '''
+    Load the manifest of a ragged array from a json file
+    '''
+    with open(filename) as f:
+        return json.load(f)
+
+
+def concatenate_ragged(datasets) -> xr.Dataset:
+    '''
+    Concatenate ragged array datasets along both the 'traj' and the 'obs' dimensions
+    '''
+    # dictionary encoded variables are re-encoded with the categories used by any dataset
+    datasets = list(datasets)
+    for var in datasets[0].variables:
+        if category_table(datasets[0][var]) is None:
+            continue
+        codes, categories = categorical(np.concatenate([decode_categorical(ds[var]) for ds in datasets]))
+        splits = np.split(codes, np.cumsum([ds.sizes['traj'] for ds in datasets])[:-1])
+        for i, ds in enumerate(datasets):
+            da = ds[var].copy(data=splits[i])
+            da.attrs.update(categorical_attrs(categories))
+            datasets[i] = ds.assign({var: da})
+
+    if len(datasets) == 1:
+        ds = datasets[0].copy()
+    else:
+        traj = xr.concat([ds.drop_dims('obs') for ds in datasets], dim='traj')
+        obs = xr.concat([ds.drop_dims('traj') for ds in datasets], dim='obs')
+        ds = xr.merge([traj, obs], combine_attrs='override')
+    ds.attrs = dict(datasets[-1].attrs)
+    for var in ds.variables:
+        ds[var].encoding = dict(datasets[0][var].encoding)
+        if category_table(ds[var]) is not None:
+            ds[var].encoding.pop('dtype', None)  # the codes may need a larger type
+    if 'offset' in ds:
+        ds = index_trajectories(ds)
+    return ds
+
+
+def compare_manifest(manifest, files, checksum=False):
+    '''
+    Compare the manifest of a ragged array with the current list of trajectory files
+
+    :param manifest: manifest of the ragged array (see create_ragged_array.manifest)
+           files: complete list of trajectory files of the new release
+           checksum: compare the sha256 of the files (must match how the manifest was created)
+    :return: unchanged: manifest entries of the files that did not change
+             changed: files that were added or modified (in the order of files)
+             replaced: manifest entries of the files that were modified or removed
+    '''
+    previous = {entry['file']: entry for entry in manifest}
+    keys = ['mtime', 'size', 'sha256'] if checksum else ['mtime', 'size']
+
+    unchanged, changed = [], []
+    for file in files:
+        signature = file_signature(file, checksum)
+        entry = previous.pop(signature['file'], None)
+        if entry is not None and all(entry.get(k) == signature[k] for k in keys):
+            unchanged.append(entry)
+        else:
+            changed.append(file)
+            if entry is not None:
+                previous[signature['file']] = entry  # modified
+    return unchanged, changed, list(previous.values())
+
+
+def update_ragged_array(ds, manifest, files, workers=None, checksum=False):
+    '''
+    Update an existing ragged array from the current list of trajectory files. Only the files
+    that were added or modified since the manifest was created are decoded; the trajectories
+    of the removed files are dropped and the unchanged trajectories are kept as is.
+
+    The unchanged trajectories are selected with slices (runs of consecutive trajectories), so
+    a dataset opened from a file is only read when the result is computed or written. The result
+    is a new dataset that has to be written in full: see append_ragged_array to update a file
+    in place when files were only added or modified.
+
+    :param ds: ragged array xr.Dataset (see create_ragged_array.to_xarray)
+           manifest: manifest of ds (see create_ragged_array.manifest)
+           files: complete list of trajectory files of the new release
+           workers: number of processes used to decode the modified files
+           checksum: compare the sha256 of the files (must match how the manifest was created)
+    :return: updated xr.Dataset, updated manifest
+             the unchanged trajectories come first (in their previous order) followed by
+             the modified and added ones
+    '''
+    unchanged, modified, _ = compare_manifest(manifest, files, checksum)
+
+    # trajectories kept from the existing dataset
+    traj_index = pd.Index(ds.ID.values).get_indexer([entry['ID'] for entry in unchanged])
+    if np.any(traj_index < 0):
+        raise ValueError('The manifest does not correspond to the dataset (unknown ID).')
+    keep = np.zeros(ds.sizes['traj'], dtype='bool')
+    keep[traj_index] = True
+
+    # runs of consecutive kept trajectories
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], keep.astype('int8'), [0]])))
+    offset = np.insert(np.cumsum(ds.rowsize.values), 0, 0)
+    datasets = [ds.isel(traj=slice(start, end), obs=slice(offset[start], offset[end])) for start, end in zip(edges[::2], edges[1::2])]
+
+    # keep the manifest order consistent with the dataset
+    order = np.argsort(traj_index)
+    unchanged = [unchanged[i] for i in order]
+
+    new_manifest = unchanged
+    if modified:
+        ra = create_ragged_array(modified, workers=workers, variables=[var for var in SCHEMA_VARIABLES if var in ds])
+        datasets.append(ra.to_xarray())
+        new_manifest = unchanged + ra.manifest(checksum)
+    if not datasets:
+        datasets = [ds.isel(traj=slice(0, 0), obs=slice(0, 0))]
+
+    ds_new = concatenate_ragged(datasets)
+    ds_new.attrs['date_created'] = datetime.now().isoformat()
+
+    # recompute the offsets
+    offset = 0
+    for entry in new_manifest:
+        entry['offset'] = offset
+        offset += entry['rowsize']
+
+    return ds_new, new_manifest
+
+
+def to_seconds(time) -> np.ndarray:
+    '''
+    Convert datetime64 (or numerical seconds since 1970-01-01) to float seconds, NaT as NaN
+    '''
+    time = np.asarray(time)
+    if time.dtype.kind == 'M':
+        seconds = time.astype('datetime64[s]').astype('int64').astype('float64')
+        seconds[np.isnat(time)] = np.nan
+        return seconds
+    else:
+        return time.astype('float64')
+
+
+def grid_cell(lon, lat, cell_size):
+    '''
+    Index of the cell of a regular lon/lat grid containing each position (-1 for missing positions)
+    '''
+    nlon = int(np.ceil(360 / cell_size))
+    nlat = int(np.ceil(180 / cell_size))
+    ilon = np.clip(np.floor((np.asarray(lon, dtype='float64') + 180) / cell_size), 0, nlon - 1)
+    ilat = np.clip(np.floor((np.asarray(lat, dtype='float64') + 90) / cell_size), 0, nlat - 1)
+    cell = ilat * nlon + ilon
+    return np.where(np.isfinite(cell), cell, -1).astype('int64')
+
+
+def index_ragged_array(lon, lat, time, rowsize, cell_size=1.0) -> xr.Dataset:
+    '''
+    Build the spatio-temporal index of a ragged array
+
+    The index contains the bounding box and time span of each trajectory, and the 'runs' of
+    consecutive observations of a trajectory located in the same cell of a regular grid of
+    `cell_size` degrees. The runs are sorted by cell so the observations possibly inside a
+    region are found with a binary search on the cells intersecting the region.
+
+    :param lon, lat, time: observations of the ragged array
+           rowsize: number of observations per trajectory
+           cell_size: resolution of the grid [degrees]
+    :return: xr.Dataset with dimensions ['traj'] and ['run']
+    '''
+    rowsize = np.asarray(rowsize, dtype='int64')
+    lon = np.asarray(lon, dtype='float64')
+    lat = np.asarray(lat, dtype='float64')
+    seconds = to_seconds(time)
+    traj_idx = np.insert(np.cumsum(rowsize), 0, 0)
+
+    # bounding box and time span of the trajectories (empty trajectories stay NaN)
+    bounds = np.full((6, len(rowsize)), np.nan)
+    nonempty = rowsize > 0
+    if np.any(nonempty):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)  # trajectories without valid values
+            for k, (var, func) in enumerate([(lon, np.fmin), (lon, np.fmax), (lat, np.fmin),
+                                             (lat, np.fmax), (seconds, np.fmin), (seconds, np.fmax)]):
+                bounds[k, nonempty] = func.reduceat(var, traj_idx[:-1][nonempty])
+
+    # runs of consecutive observations in the same cell
+    cell = grid_cell(lon, lat, cell_size)
+    change = np.ones(len(cell), dtype='bool')
+    change[1:] = cell[1:] != cell[:-1]
+    change[traj_idx[:-1][nonempty]] = True
+    run_start = np.flatnonzero(change)
+    run_end = np.append(run_start[1:], len(cell))
+    run_cell = cell[run_start]
+    run_traj = np.searchsorted(traj_idx, run_start, side='right') - 1
+    run_time_min = np.fmin.reduceat(seconds, run_start) if len(run_start) else np.zeros(0)
+    run_time_max = np.fmax.reduceat(seconds, run_start) if len(run_start) else np.zeros(0)
+
+    # missing positions never match a region
+    valid = run_cell >= 0
+    order = np.lexsort((run_start[valid], run_cell[valid]))
+
+    return xr.Dataset(
+        data_vars=dict(
+            lon_min=(['traj'], bounds[0], {'long_name': 'Minimum longitude of the trajectory', 'units': 'degrees_east'}),
+            lon_max=(['traj'], bounds[1], {'long_name': 'Maximum longitude of the trajectory', 'units': 'degrees_east'}),
+            lat_min=(['traj'], bounds[2], {'long_name': 'Minimum latitude of the trajectory', 'units': 'degrees_north'}),
+            lat_max=(['traj'], bounds[3], {'long_name': 'Maximum latitude of the trajectory', 'units': 'degrees_north'}),
+            time_min=(['traj'], bounds[4], {'long_name': 'First time of the trajectory (seconds since 1970-01-01)', 'units': 's'}),
+            time_max=(['traj'], bounds[5], {'long_name': 'Last time of the trajectory (seconds since 1970-01-01)', 'units': 's'}),
+            run_cell=(['run'], run_cell[valid][order], {'long_name': 'Grid cell of the run of observations', 'units': '-'}),
+            run_start=(['run'], run_start[valid][order], {'long_name': 'Index of the first observation of the run', 'units': '-'}),
+            run_end=(['run'], run_end[valid][order], {'long_name': 'Index after the last observation of the run', 'units': '-'}),
+            run_traj=(['run'], run_traj[valid][order], {'long_name': 'Trajectory index of the run', 'units': '-'}),
+            run_time_min=(['run'], run_time_min[valid][order], {'long_name': 'First time of the run (seconds since 1970-01-01)', 'units': 's'}),
+            run_time_max=(['run'], run_time_max[valid][order], {'long_name': 'Last time of the run (seconds since 1970-01-01)', 'units': 's'}),
+        ),
+        attrs={'cell_size': cell_size, 'nlon': int(np.ceil(360 / cell_size)), 'nlat': int(np.ceil(180 / cell_size))},
+    )
+
+
+def create_index(ds: xr.Dataset, cell_size=1.0) -> xr.Dataset:
+    '''
+    Spatio-temporal index of an existing ragged array dataset (see index_ragged_array).
+    The index can be saved with `.to_netcdf()` and reused with query_region().
+    '''
+    return index_ragged_array(ds.lon.values, ds.lat.values, ds.time.values, ds.rowsize.values, cell_size)
+
+
+def query_region(ds: xr.Dataset, index: xr.Dataset, lon: list = None, lat: list = None, time: list = None) -> xr.Dataset:
+    '''
+    Subset the ragged array for a region in space and time, reading only the observations
+    of the grid cells and trajectories that can intersect the region (see create_index)
+
+    :param ds: ragged array xr.Dataset (typically opened lazily)
+           index: spatio-temporal index of ds
+           lon: [min, max] longitude of the subregion
+           lat: [min, max] latitude of the subregion
+           time: [start, end] of the subregion (anything accepted by np.datetime64)
+    :return: xr.Dataset of the subregion
+    '''
+    cell_size, nlon = index.attrs['cell_size'], index.attrs['nlon']
+    lon = lon or [-180, 180]
+    lat = lat or [-90, 90]
+    t0, t1 = to_seconds([np.datetime64(t, 's') for t in time]) if time else (-np.inf, np.inf)
+
+    # trajectories with a bounding box and a time span intersecting the region
+    with np.errstate(invalid='ignore'):
+        candidate = (
+            (index.lon_max.values >= lon[0]) & (index.lon_min.values <= lon[1])
+            & (index.lat_max.values >= lat[0]) & (index.lat_min.values <= lat[1])
+        )
+        if time:
+            candidate &= (index.time_max.values >= t0) & (index.time_min.values <= t1)
+
+    # runs located in the cells intersecting the region (one contiguous range of cells per row of the grid)
+    run_cell = index.run_cell.values
+    c0, c1 = grid_cell([lon[0], lon[1]], [lat[0], lat[1]], cell_size)
+    runs = []
+    for row in range(c0 // nlon, c1 // nlon + 1):
+        first = np.searchsorted(run_cell, row * nlon + c0 % nlon, side='left')
+        last = np.searchsorted(run_cell, row * nlon + c1 % nlon, side='right')
+        runs.append(np.arange(first, last))
+    runs = np.concatenate(runs) if runs else np.zeros(0, dtype='int64')
+    runs = runs[candidate[index.run_traj.values[runs]]]
+    if time:
+        with np.errstate(invalid='ignore'):
+            runs = runs[(index.run_time_max.values[runs] >= t0) & (index.run_time_min.values[runs] <= t1)]
+
+    # observations of the remaining runs (only those are read from ds)
+    runs = runs[np.argsort(index.run_start.values[runs])]
+    start, end = index.run_start.values[runs], index.run_end.values[runs]
+    length = end - start
+    obs = np.repeat(start - np.insert(np.cumsum(length), 0, 0)[:-1], length) + np.arange(np.sum(length))
+    subset = ds[['lon', 'lat', 'time']].isel(obs=obs)
+
+    # exact selection on the candidate observations
+    mask = np.ones(len(obs), dtype='bool')
+    mask &= (subset.lon.values >= lon[0]) & (subset.lon.values <= lon[1])
+    mask &= (subset.lat.values >= lat[0]) & (subset.lat.values <= lat[1])
+    if time:
+        seconds = to_seconds(subset.time.values)
+        mask &= (seconds >= t0) & (seconds <= t1)
+    obs = obs[mask]
+
+    # trajectories of the selected observations
+    traj = np.unique(np.searchsorted(np.cumsum(ds.rowsize.values), obs, side='right'))
+
+    return ds.isel(obs=obs, traj=traj).drop_vars(['offset', 'id_order'], errors='ignore').compute()
+
+
+OFFSET_ATTRS = {'long_name': 'Index of the first observation of the trajectory', 'units': '-'}
+ID_ORDER_ATTRS = {'long_name': 'Index of the trajectories sorted by ID', 'units': '-'}
+
+
+def index_trajectories(ds: xr.Dataset) -> xr.Dataset:
+    '''
+    (Re)compute the lookup variables of the trajectories: `offset`, the index of the first
+    observation of each trajectory and `id_order`, the trajectories sorted by ID (see get_trajectory)
+    '''
+    rowsize = ds.rowsize.values
+    offset = np.zeros(len(rowsize), dtype='int64')
+    np.cumsum(rowsize[:-1], out=offset[1:])
+    return ds.assign(
+        offset=(['traj'], offset, OFFSET_ATTRS),
+        id_order=(['traj'], np.argsort(ds.ID.values, kind='stable'), ID_ORDER_ATTRS),
+    )
+
+
+@nb.njit(cache=True, nogil=True)
+def _lookup_kernel(values, order, keys, out):
+    # binary search of each key in values[order] (sorted), -1 when not found
+    for k in range(len(keys)):
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if values[order[mid]] < keys[k]:
+                lo = mid + 1
+            else:
+                hi = mid
+        out[k] = order[lo] if lo < len(order) and values[order[lo]] == keys[k] else -1
+
+
+def trajectory_index(ds: xr.Dataset, ids) -> np.ndarray:
+    '''
+    Position along the 'traj' dimension of the trajectories ids, O(log(nb_traj)) per ID
+    using the persisted `id_order` (sorted on the fly when the dataset does not have it)
+
+    :param ds: ragged array xr.Dataset
+           ids: drifter ID or list of IDs
+    :return: int64 array of the trajectory indices
+    '''
+    values = np.asarray(ds.ID.values, dtype='int64')
+    order = ds.id_order.values if 'id_order' in ds else np.argsort(values, kind='stable')
+    keys = np.atleast_1d(np.asarray(ids, dtype='int64'))
+    index = np.empty(len(keys), dtype='int64')
+    _lookup_kernel(values, np.asarray(order, dtype='int64'), keys, index)
+    if np.any(index < 0):
+        raise KeyError(f'Unknown ID(s): {keys[index < 0].tolist()}')
+    return index
+
+
+def trajectory_offsets(ds: xr.Dataset) -> np.ndarray:
+    '''
+    Index of the first observation of each trajectory (persisted `offset` or prefix sum of rowsize)
+    '''
+    if 'offset' in ds:
+        return np.asarray(ds.offset.values, dtype='int64')
+    return np.insert(np.cumsum(ds.rowsize.values), 0, 0)[:-1]
+
+
+def get_trajectory(ds: xr.Dataset, id) -> xr.Dataset:
+    '''
+    Ragged array of one drifter. The observations are selected with a slice, so
+    the variables are views of ds (no copy) when they are numpy arrays.
+
+    :param ds: ragged array xr.Dataset
+           id: drifter ID
+    :return: xr.Dataset with one trajectory
+    '''
+    i = trajectory_index(ds, id)[0]
+    start = trajectory_offsets(ds)[i]
+    subset = ds.isel(traj=slice(i, i + 1), obs=slice(start, start + int(ds.rowsize.values[i])))
+    return index_trajectories(subset) if 'offset' in ds else subset
+
+
+def get_trajectories(ds: xr.Dataset, ids) -> xr.Dataset:
+    '''
+    Ragged array of several drifters (in the order of ids), looked up in one vectorized call.
+    When the trajectories are contiguous in ds the observations are selected with a slice
+    (views of ds), otherwise they are gathered in a copy.
+
+    :param ds: ragged array xr.Dataset
+           ids: list of drifter IDs
+    :return: xr.Dataset with the trajectories
+    '''
+    traj = trajectory_index(ds, ids)
+    start = trajectory_offsets(ds)[traj]
+    length = ds.rowsize.values[traj].astype('int64')
+    if len(traj) and np.all(np.diff(traj) == 1):
+        subset = ds.isel(traj=slice(traj[0], traj[-1] + 1), obs=slice(start[0], start[0] + np.sum(length)))
+    else:
+        obs = np.repeat(start - np.insert(np.cumsum(length), 0, 0)[:-1], length) + np.arange(np.sum(length))
+        subset = ds.isel(traj=traj, obs=obs)
+    return index_trajectories(subset) if 'offset' in ds else subset
+
+
+def ragged_encoding(ds: xr.Dataset, target_chunk_bytes=2**22, complevel=4, shuffle=True):
+    '''
+    netCDF4 encoding (chunking and compression) of the ragged array variables
+
+    HDF5 chunks have a fixed shape, so all the variables along 'obs' use the same number of
+    observations per chunk, `target_chunk_bytes` of float32 values. The trajectories covered by
+    each chunk are returned so a trajectory can be read by decompressing only its own chunks.
+
+    :param ds: ragged array xr.Dataset
+           target_chunk_bytes: size of the chunks of the float32 'obs' variables
+           complevel: zlib compression level (0: no compression)
+           shuffle: apply the HDF5 shuffle filter before compression
+    :return: encoding: dict of encoding per variable (see xr.Dataset.to_netcdf)
+             chunk_size: number of observations per chunk
+             chunk_traj: index of the first trajectory of each chunk
+    '''
+    nb_obs = ds.sizes['obs']
+    chunk_size = int(max(1, min(nb_obs, target_chunk_bytes // 4)))
+    traj_idx = np.insert(np.cumsum(ds.rowsize.values), 0, 0)
+    chunk_traj = np.searchsorted(traj_idx, np.arange(0, nb_obs, chunk_size), side='right') - 1
+
+    encoding = {}
+    for var in ds.variables:
+        # keep the encoding related to the values (e.g. time units), not to the storage
+        encoding[var] = {k: v for k, v in ds[var].encoding.items() if k in ['units', 'calendar', 'dtype', '_FillValue']}
+        if complevel:
+            encoding[var].update({'zlib': True, 'complevel': complevel, 'shuffle': shuffle})
+        if ds[var].dims == ('obs',) and nb_obs:
+            encoding[var]['chunksizes'] = (chunk_size,)
+        elif ds[var].dims == ('traj',) and ds.sizes['traj'] and ds[var].dtype.kind != 'S':
+            # fixed-width strings have an extra dimension on disk and keep the default chunks
+            encoding[var]['chunksizes'] = (ds.sizes['traj'],)
+
+    return encoding, chunk_size, chunk_traj
+
+
+def to_netcdf(ds: xr.Dataset, filename, target_chunk_bytes=2**22, complevel=4, shuffle=True, profile=None, unlimited=False):
+    '''
+    Write the ragged array in a chunked and compressed netCDF file (see ragged_encoding).
+    The chunk size and the first trajectory of each chunk are stored in the global attributes
+    'obs_chunk_size' and 'obs_chunk_traj'.
+
+    :param profile: optional ingestion_profiler recording the time spent as the stage 'to_netcdf'
+           unlimited: create 'traj' and 'obs' as unlimited dimensions, so the file can be
+                      updated in place (see append_ragged_array)
+    '''
+    with (NO_PROFILE if profile is None else profile.stage('to_netcdf')):
+        encoding, chunk_size, chunk_traj = ragged_encoding(ds, target_chunk_bytes, complevel, shuffle)
+        ds = ds.copy()
+        ds.attrs['obs_chunk_size'] = chunk_size
+        ds.attrs['obs_chunk_traj'] = chunk_traj.astype('int32')
+        ds.to_netcdf(filename, encoding=encoding, unlimited_dims=['traj', 'obs'] if unlimited else None)
+
+
+def _encode_values(da: xr.DataArray, encoding) -> np.ndarray:
+    '''
+    Values of da as stored in the netCDF file (e.g. dates in seconds) for the given encoding
+    '''
+    variable = xr.Variable(da.dims, da.values, encoding=dict(encoding))
+    return np.asarray(xr.conventions.encode_cf_variable(variable).values)
+
+
+def append_ragged_array(filename, manifest, files, workers=None, checksum=False) -> list:
+    '''
+    Update a ragged array netCDF file in place from the current list of trajectory files.
+    Only the added and modified files are decoded and written: the added trajectories are
+    appended at the end of the 'traj' and 'obs' dimensions and the modified trajectories are
+    overwritten at their position. The observations of the unchanged trajectories are neither
+    read nor rewritten (only the 'traj' variables offset and id_order are recomputed).
+
+    The file must be written by to_netcdf(..., unlimited=True). The dimensions of a netCDF
+    file can not shrink, so the files removed from the release and the modified trajectories
+    with a different number of observations are not supported: use update_ragged_array
+    (full rewrite) in those cases.
+
+    :param filename: netCDF file of the ragged array (see to_netcdf)
+           manifest: manifest of the file (see create_ragged_array.manifest)
+           files: complete list of trajectory files of the new release
+           workers: number of processes used to decode the added and modified files
+           checksum: compare the sha256 of the files (must match how the manifest was created)
+    :return: updated manifest (trajectories in the order of the file)
+    '''
+    unchanged, changed, replaced = compare_manifest(manifest, files, checksum)
+    if not changed:
+        if replaced:
+            raise ValueError(f'{len(replaced)} file(s) were removed, use update_ragged_array')
+        return manifest
+
+    modified = {os.path.abspath(file) for file in changed}
+    removed = [entry['file'] for entry in replaced if entry['file'] not in modified]
+    if removed:
+        raise ValueError(f'{len(removed)} file(s) were removed, use update_ragged_array: {removed[:5]}')
+    replaced = {entry['file']: entry for entry in replaced}
+
+    with xr.open_dataset(filename) as ds:
+        if not all(dim in ds.encoding.get('unlimited_dims', ()) for dim in ['traj', 'obs']):
+            raise ValueError(f'{filename} has fixed dimensions, write it with to_netcdf(..., unlimited=True)')
+        variables = [var for var in ds.variables if ds[var].dims in [('traj',), ('obs',)] and var not in ['offset', 'id_order']]
+        encoding = {var: {k: v for k, v in ds[var].encoding.items() if k in ['units', 'calendar', 'dtype', '_FillValue']} for var in variables}
+        categories = {var: category_table(ds[var]) for var in variables if category_table(ds[var]) is not None}
+        index = pd.Index(ds.ID.values)
+        rowsize = ds.rowsize.values
+        nb_traj, nb_obs = ds.sizes['traj'], ds.sizes['obs']
+
+    ra = create_ragged_array(changed, workers=workers, variables=[var for var in SCHEMA_VARIABLES if var in variables])
+    new = ra.to_xarray()
+    missing = set(variables) - set(new.variables)
+    if missing:
+        raise ValueError(f'The variables {sorted(missing)} of {filename} are not in SCHEMA, use update_ragged_array')
+
+    # position of each changed trajectory in the file (-1: appended)
+    position = np.array([
+        index.get_loc(replaced[os.path.abspath(file)]['ID']) if os.path.abspath(file) in replaced else -1
+        for file in changed
+    ], dtype='int64')
+    existing = position >= 0
+    resized = existing & (rowsize[np.maximum(position, 0)] != new.rowsize.values)
+    if np.any(resized):
+        raise ValueError(f'The number of observations of {int(resized.sum())} modified trajectories changed, use update_ragged_array')
+    offset = np.insert(np.cumsum(rowsize), 0, 0)
+    new_offset = np.insert(np.cumsum(new.rowsize.values), 0, 0)
+    added_obs = np.repeat(~existing, new.rowsize.values)
+
+    with nc.Dataset(filename, 'a') as f:
+        f.set_auto_maskandscale(False)
+
+        # the new categories are added after the existing ones, so the codes stored in the file are still valid
+        for var, table in categories.items():
+            values = decode_categorical(new[var])
+            table = np.concatenate([table, np.setdiff1d(values.astype('str'), table)])
+            if len(table) - 1 > np.iinfo(f.variables[var].dtype).max:
+                raise ValueError(f'Too many categories for the type of {var}, use update_ragged_array')
+            new[var] = new[var].copy(data=pd.Index(table).get_indexer(values))
+            attrs = categorical_attrs(table)
+            f.variables[var].setncattr('flag_values', attrs['flag_values'])
+            f.variables[var].setncattr('flag_meanings', attrs['flag_meanings'])
+            if len(table) > 1:
+                f.variables[var].setncattr_string('categories', attrs['categories'])
+            else:
+                f.variables[var].setncattr('categories', attrs['categories'][0])
+
+        for var in variables:
+            values = _encode_values(new[var], encoding[var])
+            if new[var].dims == ('traj',):
+                for i in np.flatnonzero(existing):
+                    f.variables[var][position[i]] = values[i]
+                f.variables[var][nb_traj:nb_traj + np.sum(~existing)] = values[~existing]
+            else:
+                for i in np.flatnonzero(existing):
+                    f.variables[var][offset[position[i]]:offset[position[i] + 1]] = values[new_offset[i]:new_offset[i + 1]]
+                f.variables[var][nb_obs:nb_obs + np.sum(added_obs)] = values[added_obs]
+
+        # lookup variables and chunk index of all the trajectories (one value per trajectory)
+        rowsize = f.variables['rowsize'][:]
+        offset = np.insert(np.cumsum(rowsize), 0, 0)
+        if 'offset' in f.variables:
+            f.variables['offset'][:] = offset[:-1]
+        if 'id_order' in f.variables:
+            f.variables['id_order'][:] = np.argsort(f.variables['ID'][:], kind='stable')
+        if 'obs_chunk_size' in f.ncattrs():
+            chunk_size = int(f.getncattr('obs_chunk_size'))
+            chunk_traj = np.searchsorted(offset, np.arange(0, offset[-1], chunk_size), side='right') - 1
+            f.setncattr('obs_chunk_traj', chunk_traj.astype('int32'))
+        f.setncattr('date_created', datetime.now().isoformat())
+
+    # manifest in the order of the file
+    entries = {index.get_loc(entry['ID']): entry for entry in unchanged}
+    for i, entry in enumerate(ra.manifest(checksum)):
+        entries[position[i] if existing[i] else nb_traj + np.sum(~existing[:i])] = entry
+    new_manifest = [entries[i] for i in sorted(entries)]
+    for i, entry in enumerate(new_manifest):
+        entry['offset'] = int(offset[i])
+    return new_manifest
+
+
+def trajectory_groups(rowsize, target_size) -> np.ndarray:
+    '''
+    Pack consecutive trajectories in groups of about `target_size` observations (a
+    trajectory is never split, a trajectory larger than target_size forms its own group)
+
+    :return: index of the first trajectory of each group, followed by the number of trajectories
+    '''
+    rowsize = np.asarray(rowsize, dtype='int64')
+    bounds = [0]
+    size = 0
+    for i, n in enumerate(rowsize):
+        if size and size + n > target_size:
+            bounds.append(i)
+            size = 0
+        size += n
+    bounds.append(len(rowsize))
+    return np.array(bounds, dtype='int64')
+
+
+def open_ragged(path, target_chunk_bytes=2**27, **kwargs):
+    '''
+    Open a ragged array file lazily with dask chunks made of whole consecutive trajectories.
+    Only `rowsize` is read to define the chunks: the trajectories are split in balanced groups of
+    about target_chunk_bytes (for the largest variable along 'obs'), so the 'obs' and 'traj'
+    chunks line up and per-trajectory functions can be applied chunk by chunk (e.g. map_blocks).
+
+    For a file written by to_netcdf, each cut is moved to the trajectory boundary nearest a
+    multiple of the stored chunk size ('obs_chunk_size'), so a dask chunk reads few values of
+    the stored chunks of its neighbours.
+
+    :param path: ragged array netCDF file (see create_ragged_array.to_xarray)
+           target_chunk_bytes: approximate size of the chunks
+           kwargs: other arguments of xr.open_dataset
+    :return: xr.Dataset of dask arrays, index of the chunk of each trajectory
+    '''
+    with nc.Dataset(path) as f:
+        rowsize = np.asarray(f['rowsize'][:], dtype='int64')
+        itemsize = max([v.dtype.itemsize for v in f.variables.values() if v.dimensions == ('obs',) and isinstance(v.dtype, np.dtype)], default=8)
+        chunk_size = int(f.getncattr('obs_chunk_size')) if 'obs_chunk_size' in f.ncattrs() else None
+
+    if len(rowsize) == 0:
+        return xr.open_dataset(path, chunks={}, **kwargs), np.zeros(0, dtype='int64')
+
+    # first trajectory of each chunk, at the quantiles of the cumulative number of observations
+    nb_obs = np.sum(rowsize)
+    nb_chunks = max(1, int(np.ceil(nb_obs * itemsize / target_chunk_bytes)))
+    cumulative = np.cumsum(rowsize)
+    cuts = nb_obs * np.arange(1, nb_chunks) / nb_chunks
+    if chunk_size:
+        # nearest multiple of the stored chunks (without the edges of the file and the
+        # duplicates, when there are fewer stored chunks than cuts), then nearest trajectory boundary
+        cuts = np.round(cuts / chunk_size) * chunk_size
+        cuts = np.unique(cuts[(cuts > 0) & (cuts < nb_obs)])
+        after = np.minimum(np.searchsorted(cumulative, cuts), len(rowsize) - 1)
+        before = np.maximum(after - 1, 0)
+        bounds = np.where(np.abs(cumulative[before] - cuts) <= np.abs(cumulative[after] - cuts), before, after) + 1
+    else:
+        bounds = np.searchsorted(cumulative, cuts, side='right')
+    bounds = np.unique(np.concatenate([[0], bounds, [len(rowsize)]]))
+
+    traj_chunks = np.diff(bounds)
+    obs_chunks = np.add.reduceat(rowsize, bounds[:-1])
+    with warnings.catch_warnings():
+        # the chunks follow the trajectories, so they can't match the stored chunks (a single chunk along 'traj')
+        warnings.filterwarnings('ignore', message='The specified chunks separate the stored chunks')
+        ds = xr.open_dataset(path, chunks={'traj': tuple(traj_chunks.tolist()), 'obs': tuple(obs_chunks.tolist())}, **kwargs)
+    return ds, np.repeat(np.arange(len(traj_chunks)), traj_chunks)
+
+
+def _arrow_column(da):
+    # dictionary encoded variables are stored as arrow dictionaries and
+    # fixed-width bytes as utf-8 strings
+    categories = category_table(da)
+    if categories is not None:
+        return pa.DictionaryArray.from_arrays(da.values, pa.array(categories, type=pa.string()))
+    if da.dtype.kind == 'S':
+        return pa.array(np.char.decode(da.values, 'utf-8', 'ignore'))
+    return pa.array(da.values)
+
+
+def _arrow_type(da):
+    if category_table(da) is not None:
+        return pa.dictionary(pa.from_numpy_dtype(da.dtype), pa.string())
+    return pa.string() if da.dtype.kind == 'S' else pa.from_numpy_dtype(da.dtype)
+
+
+def _arrow_schema(ds, variables):
+    fields = [
+        pa.field(var, _arrow_type(ds[var]), metadata={'attrs': json.dumps(ds[var].attrs, default=str)})
+        for var in variables
+    ]
+    return pa.schema(fields, metadata={'attrs': json.dumps(ds.attrs, default=str)})
+
+
+def to_parquet(ds: xr.Dataset, path, row_group_size=2**20, compression='zstd'):
+    '''
+    Export the ragged array to Apache Parquet
+
+    Two files are created in the folder `path`:
+    - traj.parquet: the variables along the 'traj' dimension (one row per trajectory)
+    - obs.parquet: the variables along the 'obs' dimension (flat columns), written in row groups
+      containing whole trajectories (about row_group_size observations each); the min/max
+      statistics of each row group allow to skip row groups when filtering (e.g. on lon/lat/time)
+
+    The index of the first trajectory of each row group is stored in the metadata of
+    obs.parquet (key 'row_group_traj') and the attributes of the variables in the metadata
+    of each field.
+
+    :param ds: ragged array xr.Dataset (see create_ragged_array.to_xarray)
+           path: output folder
+           row_group_size: target number of observations per row group
+           compression: parquet compression codec
+    '''
+    os.makedirs(path, exist_ok=True)
+    traj_vars = [var for var in ds.variables if ds[var].dims == ('traj',)]
+    obs_vars = [var for var in ds.variables if ds[var].dims == ('obs',)]
+
+    traj = pa.table([_arrow_column(ds[var]) for var in traj_vars], schema=_arrow_schema(ds, traj_vars))
+    pq.write_table(traj, os.path.join(path, 'traj.parquet'), compression=compression)
+
+    groups = trajectory_groups(ds.rowsize.values, row_group_size)
+    traj_idx = np.insert(np.cumsum(ds.rowsize.values), 0, 0)
+    schema = _arrow_schema(ds, obs_vars)
+    schema = schema.with_metadata(dict(schema.metadata, row_group_traj=json.dumps(groups.tolist())))
+
+    with pq.ParquetWriter(os.path.join(path, 'obs.parquet'), schema, compression=compression, write_statistics=True) as writer:
+        for first, last in zip(groups[:-1], groups[1:]):
+            obs = slice(traj_idx[first], traj_idx[last])
+            table = pa.table([_arrow_column(ds[var][obs]) for var in obs_vars], schema=schema)
+            writer.write_table(table, row_group_size=max(1, table.num_rows))  # one row group per call
+
+
+def read_parquet(path, columns=None, filters=None, dimension='obs') -> pd.DataFrame:
+    '''
+    Load (memory-mapped) the ragged array exported with to_parquet()
+
+    :param path: folder of the parquet files
+           columns: list of variables to read (default: all)
+           filters: predicates pushed down to the row groups, e.g. [('lon', '>=', -98), ('lon', '<=', -78)]
+           dimension: 'obs' or 'traj'
+    :return: pd.DataFrame
+    '''
+    table = pq.read_table(os.path.join(path, f'{dimension}.parquet'), columns=columns, filters=filters, memory_map=True)
+    return table.to_pandas()
+
+
+# fields of the Awkward Array (in order of SCHEMA), per trajectory and per observation
+AK_TRAJ_FIELDS = ['ID', 'rowsize'] + [v.name for v in SCHEMA if v.dim == 'traj' and v.name != 'ID']
+AK_OBS_FIELDS = [v.name for v in SCHEMA if v.dim == 'obs']
+
+
+def ak_offsets(rowsize):
+    '''
+    Pointer to the start of each trajectory, using 64-bit integers only when the
+    number of observations does not fit in 32-bit
+    '''
+    offset = np.zeros(len(rowsize) + 1, dtype='int64')
+    np.cumsum(rowsize, out=offset[1:])
+    if offset[-1] < np.iinfo('int32').max:
+        return ak.layout.Index32(offset.astype('int32'))
+    else:
+        return ak.layout.Index64(offset)
+
+
+def ak_attrs(attrs) -> dict:
+    '''
+    Attributes as JSON-serializable parameters (numpy scalars and arrays read from netCDF are converted to python types)
+    '''
+    return json.loads(json.dumps(attrs, default=lambda value: value.tolist()))
+
+
+def ak_field(da: xr.DataArray, offset=None):
+    '''
+    Awkward layout of one variable of the ragged array. The numerical variables are
+    wrapped without copy; the variables along 'obs' are split in lists using offset.
+    '''
+    values = da.values
+    attrs = ak_attrs(da.attrs)
+    categories = category_table(da)
+    if categories is not None:
+        # dictionary encoded strings: the codes index the (variable length) categories
+        return ak.layout.IndexedArray64(
+            ak.layout.Index64(values.astype('int64')),
+            ak.from_iter(categories.tolist(), highlevel=False),
+            parameters={'__array__': 'categorical', 'attrs': attrs},
         )
+    elif values.dtype.kind in 'SUO':
+        # the string formats "S" and "U" are not supported as NumpyArray primitives
+        # In that situation, we used `ak.with_parameters` that calls `ak.from_numpy` instead
+        # to convert from `S15` to variable length bytestrings. This is a temporary solution,
+        # we are currently working on a dedicated parameters/attributes for Awkward Array
+        return ak.with_parameter(values, 'attrs', attrs, highlevel=False)
+    elif offset is None:
+        return ak.layout.NumpyArray(values, parameters={'attrs': attrs})
+    elif isinstance(offset, ak.layout.Index32):
+        return ak.layout.ListOffsetArray32(offset, ak.layout.NumpyArray(values), parameters={'attrs': attrs})
+    else:
+        return ak.layout.ListOffsetArray64(offset, ak.layout.NumpyArray(values), parameters={'attrs': attrs})
+
+
+def ak_virtual_field(da: xr.DataArray, offset=None, cache=None):
+    '''
+    Same as ak_field() but the variable is only loaded (e.g. from the netCDF file) on first access
+    and then kept in cache
+    '''
+    empty = da.isel({da.dims[0]: slice(0, 0)})
+    if offset is None:
+        form = ak_field(empty).form
+        length = da.shape[0]
+    else:
+        form = ak_field(empty, type(offset)(np.zeros(1, dtype=np.asarray(offset).dtype))).form
+        length = len(offset) - 1
+    return ak.virtual(ak_field, args=(da, offset), form=form, length=length, cache=cache, highlevel=False)
+
+
+def create_ak(ds: xr.Dataset, lazy=False, variables=None) -> ak.Array:
+    '''
+    Convert the ragged array xr.Dataset to an Awkward Array
+
+    :param ds: ragged array (see create_ragged_array.to_xarray)
+           lazy: if True, each field is only read from ds when first accessed (use with a
+                 dataset opened lazily to avoid reading the unused variables from the file)
+           variables: names of the fields (None: all the variables of ds, see SCHEMA); the
+                      other variables are never read from ds
+    :return: ak.Array
+    '''
+    if variables is None:
+        names = AK_TRAJ_FIELDS + AK_OBS_FIELDS
+    else:
+        names = ['rowsize'] + [v.name for v in select_variables([var for var in variables if var != 'rowsize'])]
+    traj_fields = [var for var in AK_TRAJ_FIELDS if var in names and var in ds]
+    obs_fields = [var for var in AK_OBS_FIELDS if var in names and var in ds]
+
+    if lazy:
+        cache = OrderedDict()  # materialized fields (weak-referenceable mapping, kept alive by the ak.Array)
+        field = functools.partial(ak_virtual_field, cache=cache)
+    else:
+        field = ak_field
+
+    # pointer to the start of each trajectory
+    offset = ak_offsets(ds.rowsize.values)
+
+    obs = ak.layout.RecordArray(
+        [field(ds[var], offset) for var in obs_fields],
+        obs_fields,
+        len(ds.rowsize),
     )
-    
-    # the string formats "S" and "U" are not supported as NumpyArray primitives
-    # In that situation, we used `ak.with_parameters` that calls `ak.from_numpy` instead 
-    # to convert from `S15` to variable length bytestrings. This is a temporary solution,
-    # we are currently working on a dedicated parameters/attributes for Awkward Array
+
     array = ak.Array(
         ak.layout.RecordArray(
-            [
-                ak.layout.NumpyArray(ds.ID, parameters={'attrs': ds.ID.attrs}),
-                ak.layout.NumpyArray(ds.rowsize, parameters={'attrs': ds.rowsize.attrs}),
-                ak.layout.NumpyArray(ds.location_type, parameters={'attrs': ds.location_type.attrs}),
-                ak.layout.NumpyArray(ds.WMO, parameters={'attrs': ds.WMO.attrs}),                
-                ak.layout.NumpyArray(ds.expno, parameters={'attrs': ds.expno.attrs}),               
-                ak.layout.NumpyArray(ds.deploy_date.values, parameters={'attrs': ds.deploy_date.attrs}),
-                ak.layout.NumpyArray(ds.deploy_lat, parameters={'attrs': ds.deploy_lat.attrs}),
-                ak.layout.NumpyArray(ds.deploy_lon, parameters={'attrs': ds.deploy_lon.attrs}),
-                ak.layout.NumpyArray(ds.end_date.values, parameters={'attrs': ds.end_date.attrs}),
-                ak.layout.NumpyArray(ds.end_lat, parameters={'attrs': ds.end_lat.attrs}),
-                ak.layout.NumpyArray(ds.end_lon, parameters={'attrs': ds.end_lon.attrs}),
-                ak.layout.NumpyArray(ds.drogue_lost_date.values, parameters={'attrs': ds.drogue_lost_date.attrs}),
-                ak.layout.NumpyArray(ds.type_death, parameters={'attrs': ds.type_death.attrs}),
-                ak.with_parameter(ds.type_buoy.values, 'attrs', ds.type_buoy.attrs, highlevel=False),
-                ak.with_parameter(ds.DeploymentShip.values, 'attrs', ds.DeploymentShip.attrs, highlevel=False),
-                ak.with_parameter(ds.DeploymentStatus.values, 'attrs', ds.DeploymentStatus.attrs, highlevel=False),
-                ak.with_parameter(ds.BuoyTypeManufacturer.values, 'attrs',ds.BuoyTypeManufacturer.attrs, highlevel=False),
-                ak.with_parameter(ds.BuoyTypeSensorArray.values, 'attrs', ds.BuoyTypeSensorArray.attrs, highlevel=False),
-                ak.layout.NumpyArray(ds.CurrentProgram, parameters={'attrs': ds.CurrentProgram.attrs}),
-                ak.with_parameter(ds.PurchaserFunding.values, 'attrs', ds.PurchaserFunding.attrs, highlevel=False),
-                ak.with_parameter(ds.SensorUpgrade.values, 'attrs', ds.SensorUpgrade.attrs, highlevel=False),
-                ak.with_parameter(ds.Transmissions.values, 'attrs', ds.Transmissions.attrs, highlevel=False),
-                ak.with_parameter(ds.DeployingCountry.values, 'attrs', ds.DeployingCountry.attrs, highlevel=False),
-                ak.with_parameter(ds.DeploymentComments.values, 'attrs', ds.DeploymentComments.attrs, highlevel=False),
-                ak.layout.NumpyArray(ds.ManufactureYear, parameters={'attrs': ds.ManufactureYear.attrs}),
-                ak.layout.NumpyArray(ds.ManufactureMonth, parameters={'attrs': ds.ManufactureMonth.attrs}),
-                ak.with_parameter(ds.ManufactureSensorType.values, 'attrs', ds.ManufactureSensorType.attrs, highlevel=False),
-                ak.layout.NumpyArray(ds.ManufactureVoltage, parameters={'attrs': ds.ManufactureVoltage.attrs}),
-                ak.layout.NumpyArray(ds.FloatDiameter, parameters={'attrs': ds.FloatDiameter.attrs}),
-                ak.layout.NumpyArray(ds.SubsfcFloatPresence, parameters={'attrs': ds.SubsfcFloatPresence.attrs}),
-                ak.with_parameter(ds.DrogueType.values, 'attrs', ds.DrogueType.attrs, highlevel=False),
-                ak.layout.NumpyArray(ds.DrogueLength, parameters={'attrs': ds.DrogueLength.attrs}),
-                ak.layout.NumpyArray(ds.DrogueBallast, parameters={'attrs': ds.DrogueBallast.attrs}),
-                ak.layout.NumpyArray(ds.DragAreaAboveDrogue, parameters={'attrs': ds.DragAreaAboveDrogue.attrs}),
-                ak.layout.NumpyArray(ds.DragAreaOfDrogue, parameters={'attrs': ds.DragAreaOfDrogue.attrs}),
-                ak.layout.NumpyArray(ds.DragAreaRatio, parameters={'attrs': ds.DragAreaRatio.attrs}),
-                ak.layout.NumpyArray(ds.DrogueCenterDepth, parameters={'attrs': ds.DrogueCenterDepth.attrs}),
-                ak.with_parameter(ds.DrogueDetectSensor.values, 'attrs', ds.DrogueDetectSensor.attrs, highlevel=False),
-                obs.layout,
-            ],
-            [
-                'ID',
-                'rowsize',
-                'location_type',
-                'WMO',
-                'expno',
-                'deploy_date',
-                'deploy_lat',
-                'deploy_lon',
-                'end_date',
-                'end_lat',
-                'end_lon',
-                'drogue_lost_date',
-                'type_death',
-                'type_buoy',
-                'DeploymentShip',
-                'DeploymentStatus',
-                'BuoyTypeManufacturer',
-                'BuoyTypeSensorArray',
-                'CurrentProgram',
-                'PurchaserFunding',
-                'SensorUpgrade',
-                'Transmissions',
-                'DeployingCountry',
-                'DeploymentComments',
-                'ManufactureYear',
-                'ManufactureMonth',
-                'ManufactureSensorType',
-                'ManufactureVoltage',
-                'FloatDiameter',
-                'SubsfcFloatPresence',
-                'DrogueType',
-                'DrogueLength',
-                'DrogueBallast',
-                'DragAreaAboveDrogue',
-                'DragAreaOfDrogue',
-                'DragAreaRatio',
-                'DrogueCenterDepth',
-                'DrogueDetectSensor',
-                'obs',
-            ],
-            parameters={'attrs': ds.attrs}  # global attributes
+            [field(ds[var]) for var in traj_fields] + [obs],
+            traj_fields + ['obs'],
+            parameters={'attrs': ak_attrs(ds.attrs)}  # global attributes
         )
     )
     return array